@@ -1,6 +1,9 @@
 # coding=utf-8
 
 import hashlib
+import json
+import shutil
+import threading
 import time
 import os
 
@@ -8,11 +11,19 @@ import certifi
 import urllib3
 
 from utils.custom_logging import make_logger
-from utils.threadpool import ThreadPool
+from utils.threadpool import current_cancel_token, get_shared_pool, worker_resource
 
 logger = make_logger(__name__)
 
 
+def _new_hash(method: str):
+
+    try:
+        return getattr(hashlib, method)()
+    except AttributeError:
+        raise RuntimeError('cannot find method "{}" in hashlib'.format(method))
+
+
 def get_hash(data, method: str = 'md5'):
 
     if not isinstance(data, bytes):
@@ -34,6 +45,437 @@ def get_http_pool():
                                ca_certs=certifi.where())
 
 
+def _if_range(validators: dict) -> str or None:
+    """
+    :return: value for the If-Range header of a request for part of a file with these validators, if any
+    """
+    etag = validators.get('etag')
+    # Weak entity tags cannot be used in If-Range
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validators.get('last_modified')
+
+
+class _Segment:
+    """Byte range [start, end) of a ranged download; "position" is the next byte to fetch"""
+
+    __slots__ = ('position', 'end', 'active', 'failures', 'fetch_start', 'fetch_time')
+
+    def __init__(self, start: int, end: int):
+        self.position = start
+        self.end = end
+        self.active = False
+        self.failures = 0
+        # Position and time at which the current request started, to measure its speed
+        self.fetch_start = start
+        self.fetch_time = None
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.position
+
+    def eta(self, now: float) -> float:
+        if self.fetch_time is None or now <= self.fetch_time:
+            return float('inf')
+        rate = (self.position - self.fetch_start) / (now - self.fetch_time)
+        if rate <= 0:
+            return float('inf')
+        return self.remaining / rate
+
+
+class _RangedDownload:
+    """
+    Fetches the segments of a file over several connections, each with its own Range request, and writes them at
+    their offset in a preallocated file
+
+    Workers take the next pending segment; once there are none left, an idle worker splits the active segment
+    expected to finish last and takes its second half, so that a slow connection does not hold up the download.
+
+    Segments start on a chunk boundary (chunks are Downloader.min_segment_size long). When the file has validators,
+    each chunk is hashed as it is written, and the hashes are saved next to the partial file (see
+    Downloader.state_filename) so that an interrupted download can be resumed.
+
+    A download made of a single segment starting at byte 0, fetched by a single worker, can also feed the digests
+    of the whole file ("hashes") as blocks are written; they are dropped if a block is written out of order, after
+    a failed request.
+    """
+
+    # Minimum number of seconds between two saves of the state of the download
+    save_interval = 1
+
+    def __init__(self, downloader: 'Downloader', filename: str, total: int, segments: list, validators: dict = None,
+                 chunks: dict = None, hashes: list = None):
+        self.downloader = downloader
+        self.filename = filename
+        self.total = total
+        self.chunk_size = downloader.min_segment_size
+        self.segments = segments
+        # ETag and Last-Modified of the file, to make sure it does not change between two requests
+        self.validators = validators
+        self.if_range = _if_range(validators) if validators else None
+        # Hashes of the chunks written so far, by index
+        self.chunks = dict(chunks or {})
+        # (method, hash) of the whole file, and number of bytes fed to them so far
+        self.hashes = hashes
+        self.hashed = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.progress_lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.saved_at = 0
+        self.cancel_token = current_cancel_token()
+        self.received = total - sum(segment.remaining for segment in segments)
+        self.active = 0
+        self.failed = False
+        self.closed = False
+        # Set when the server answers with the whole file, because it ignores Range requests or because the file
+        # changed since the validators were read; the download should then be done with a single request
+        self.unsupported = False
+        self.start_time = None
+
+    @property
+    def resumable(self) -> bool:
+        return self.if_range is not None
+
+    @property
+    def digests(self) -> dict or None:
+        """
+        :return: digests of the whole file, None if they could not be computed in order
+        """
+        if self.hashes is None or self.hashed != self.total:
+            return None
+        return {method: hash_.hexdigest() for method, hash_ in self.hashes}
+
+    def is_complete(self) -> bool:
+        return all(segment.remaining == 0 for segment in self.segments)
+
+    def _fail(self, unsupported: bool = False):
+        with self.lock:
+            self.failed = True
+            self.unsupported = self.unsupported or unsupported
+            self.changed.notify_all()
+
+    def _next_segment(self) -> _Segment or None:
+        with self.lock:
+            if self.failed or self.closed:
+                return None
+            for segment in self.segments:
+                if not segment.active and segment.remaining > 0:
+                    break
+            else:
+                segment = self._split()
+                if segment is None:
+                    return None
+            segment.active = True
+            self.active += 1
+            return segment
+
+    def _split(self) -> _Segment or None:
+        now = time.time()
+        active = [segment for segment in self.segments if segment.active]
+        if not active:
+            return None
+        slowest = max(active, key=lambda segment: (segment.eta(now), segment.remaining))
+        if slowest.remaining < 2 * self.chunk_size:
+            return None
+        middle = slowest.position + slowest.remaining // 2
+        middle += -middle % self.chunk_size
+        if middle >= slowest.end:
+            return None
+        segment = _Segment(middle, slowest.end)
+        slowest.end = middle
+        self.segments.append(segment)
+        logger.debug('split segment at %s, %s bytes left for the new segment', middle, segment.remaining)
+        return segment
+
+    def _release(self, segment: _Segment, success: bool):
+        with self.lock:
+            segment.active = False
+            self.active -= 1
+            if not success and segment.remaining > 0:
+                # The next request starts over at the beginning of the chunk, so that its hash covers all of it
+                restart = segment.position - segment.position % self.chunk_size
+                self.received -= segment.position - restart
+                segment.position = restart
+                segment.failures += 1
+                if segment.failures > self.downloader.max_download_retries:
+                    logger.error('giving up on segment at %s', segment.position)
+                    self.failed = True
+            self.changed.notify_all()
+
+    def _is_cancelled(self) -> bool:
+        return self.failed or self.cancel_token.is_cancelled or current_cancel_token().is_cancelled
+
+    def _report_progress(self):
+        with self.lock:
+            received = self.received
+        status = {'total': self.total,
+                  'downloaded': received,
+                  'status': 'downloading',
+                  'percent_complete': self.downloader._calc_progress_percent(received, self.total),
+                  'time': self.downloader._calc_eta(self.start_time, time.time(), self.total, received)}
+        with self.progress_lock:
+            self.downloader._call_progress_hooks(status)
+
+    def _hash_chunks(self, offset: int, block: bytes, chunk_hash):
+        """
+        Feeds a block written at "offset" to the hash of its chunk, recording the hash of every chunk it completes
+        :return: hash of the chunk the next block belongs to
+        """
+        block = memoryview(block)
+        while block:
+            chunk_end = min(offset - offset % self.chunk_size + self.chunk_size, self.total)
+            part = block[:chunk_end - offset]
+            chunk_hash.update(part)
+            offset += len(part)
+            block = block[len(part):]
+            if offset == chunk_end:
+                with self.lock:
+                    self.chunks[(offset - 1) // self.chunk_size] = chunk_hash.hexdigest()
+                chunk_hash = hashlib.md5()
+                self.save_state()
+        return chunk_hash
+
+    def _hash_file_block(self, offset: int, block: bytes):
+        """
+        Feeds a block written at "offset" to the digests of the whole file, or drops them if it does not follow the
+        blocks fed so far; only called with a single worker
+        """
+        if offset != self.hashed:
+            logger.debug('block written out of order at %s, the file will be hashed once complete', offset)
+            self.hashes = None
+            return
+        for _, hash_ in self.hashes:
+            hash_.update(block)
+        self.hashed += len(block)
+
+    def save_state(self, force: bool = False):
+        """
+        Saves the hashes of the chunks written so far, at most every "save_interval" seconds unless "force" is set
+        """
+        if not self.resumable:
+            return
+        with self.save_lock:
+            with self.lock:
+                now = time.time()
+                if not force and now - self.saved_at < self.save_interval:
+                    return
+                self.saved_at = now
+                state = {'url': self.downloader.url,
+                         'size': self.total,
+                         'validators': self.validators,
+                         'chunk_size': self.chunk_size,
+                         'chunks': {str(index): hexdigest for index, hexdigest in self.chunks.items()}}
+            self.downloader._save_state(state)
+
+    def _fetch(self, http_pool, segment: _Segment) -> bool:
+
+        with self.lock:
+            start, end = segment.position, segment.end
+            segment.fetch_start = start
+            segment.fetch_time = time.time()
+
+        headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+        if self.resumable:
+            headers['If-Range'] = self.if_range
+        chunk_hash = hashlib.md5()
+
+        logger.debug('requesting bytes %s-%s', start, end - 1)
+        response = http_pool.urlopen('GET', self.downloader.url,
+                                     headers=headers,
+                                     preload_content=False,
+                                     retries=self.downloader.max_download_retries)
+        try:
+            if response.status != 206:
+                logger.debug('server answered a Range request with status %s', response.status)
+                self._fail(unsupported=response.status == 200)
+                return False
+
+            block_size = self.downloader.block_size
+            with open(self.filename, 'r+b') as f:
+                f.seek(start)
+                while 1:
+                    if self._is_cancelled():
+                        return False
+
+                    start_block = time.time()
+                    block = response.read(block_size)
+                    end_block = time.time()
+
+                    with self.lock:
+                        # The end of the segment moves back when another worker takes over half of it
+                        block = block[:segment.remaining]
+                        offset = segment.position
+                        segment.position += len(block)
+                        self.received += len(block)
+                        done = segment.remaining == 0
+                    if not block:
+                        return done
+
+                    block_size = self.downloader._best_block_size(end_block - start_block, len(block))
+                    try:
+                        f.write(block)
+                    except OSError:
+                        logger.exception('cannot write to %s', self.filename)
+                        self._fail()
+                        raise
+                    if self.resumable:
+                        chunk_hash = self._hash_chunks(offset, block, chunk_hash)
+                    if self.hashes is not None:
+                        self._hash_file_block(offset, block)
+                    self._report_progress()
+
+                    if done:
+                        return True
+        finally:
+            # The response may not have been read to its end: do not hand the connection back for reuse
+            response.close()
+            response.release_conn()
+
+    def _work(self):
+
+        http_pool = worker_resource('http_pool', get_http_pool)
+        while 1:
+            segment = self._next_segment()
+            if segment is None:
+                return
+            success = False
+            try:
+                success = self._fetch(http_pool, segment)
+            except Exception as e:
+                logger.debug('segment download failed: %s', e, exc_info=True)
+            finally:
+                self._release(segment, success)
+
+    def run(self, pool) -> bool:
+        """
+        Downloads every segment, using the threads of "pool" and the calling thread
+        :return: True once the whole file has been written
+        """
+        self.start_time = time.time()
+        helpers = [pool.submit(self._work) for _ in range(self.downloader.concurrent_download - 1)]
+        try:
+            self._work()
+            with self.lock:
+                while self.active or not (self.failed or self.is_complete()):
+                    if self.cancel_token.is_cancelled:
+                        self.failed = True
+                    self.changed.wait(0.1)
+                self.closed = True
+                failed, unsupported = self.failed, self.unsupported
+        finally:
+            for helper in helpers:
+                helper.cancel()
+
+        if failed and not unsupported:
+            self.save_state(force=True)
+        return not failed
+
+
+class DownloadCache:
+    """
+    Content-addressed store of downloaded files, shared by the Downloaders given the same instance (or directory)
+
+    Files are stored under the digest they were verified against, so that any later download of the same content,
+    from any URL, is served from the cache without touching the network. The total size of the cache is bounded:
+    the least recently used files are evicted first.
+    """
+
+    def __init__(self, path: str, max_size: int = 1024 ** 3):
+        """
+        :param path: directory of the cache, created if needed
+        :param max_size: maximum total size of the files in the cache, in bytes
+        """
+        if max_size < 0:
+            raise ValueError('max size must be >= 0, got {}'.format(max_size))
+        self.path = str(path)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def blob_path(self, method: str, hexdigest: str) -> str:
+        return os.path.join(self.path, '{}-{}'.format(method, hexdigest.lower()))
+
+    def get(self, method: str, hexdigest: str) -> str or None:
+        """
+        Looks up a file by digest, and marks it as used
+
+        The file is not verified: the caller is expected to check its digest before using it.
+        :return: path of the cached file, None if it is not in the cache
+        """
+        blob = self.blob_path(method, hexdigest)
+        try:
+            os.utime(blob, None)
+        except OSError:
+            return None
+        logger.debug('cache hit for %s: %s', hexdigest, blob)
+        return blob
+
+    def put(self, path: str, method: str, hexdigest: str) -> bool:
+        """
+        Adds a verified file to the cache, then evicts the least recently used files if the cache is too large
+        :param path: file to add, hardlinked (or copied) into the cache
+        :return: True if the file has been added
+        """
+        if os.path.getsize(path) > self.max_size:
+            logger.debug('%s is too large for the cache', path)
+            return False
+        blob = self.blob_path(method, hexdigest)
+        if not self.materialize(path, blob):
+            return False
+        self.evict()
+        return True
+
+    def remove(self, method: str, hexdigest: str):
+        Downloader._remove(self.blob_path(method, hexdigest))
+
+    @staticmethod
+    def materialize(source: str, dest: str) -> bool:
+        """
+        Makes "dest" a hardlink to "source", or a copy of it where hardlinks are not supported
+        :return: True on success
+        """
+        temp = '{}.{}.tmp'.format(dest, threading.get_ident())
+        try:
+            try:
+                os.link(source, temp)
+            except OSError:
+                shutil.copyfile(source, temp)
+            os.replace(temp, dest)
+        except OSError:
+            logger.exception('cannot copy %s to %s', source, dest)
+            Downloader._remove(temp)
+            return False
+        return True
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used files until the cache fits in "max_size"
+        :return: number of files removed
+        """
+        with self.lock:
+            blobs = []
+            for name in os.listdir(self.path):
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in blobs)
+            removed = 0
+            for _, size, name in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                logger.debug('evicting %s from the cache', name)
+                Downloader._remove(os.path.join(self.path, name))
+                total -= size
+                removed += 1
+            return removed
+
+
 class Downloader:
     def __init__(self,
                  url: str,
@@ -45,50 +487,98 @@ class Downloader:
                  block_size: int = 4096 * 4,
                  progress_hooks: list = None,
                  hash_method: str = 'md5',
+                 stream: bool = False,
+                 hexdigests: dict = None,
+                 check_length: bool = False,
+                 min_segment_size: int = 1024 * 1024,
+                 resume: bool = False,
+                 cache: DownloadCache = None,
                  ):
-
-        self.pool = ThreadPool(_num_threads=concurrent_download, _basename='download', _daemon=True)
+        """
+        :param stream: write blocks to a temporary file as they arrive, instead of keeping the whole file in
+            memory; the file replaces "filename" once complete and verified
+        :param hexdigests: expected digests, by hashlib method name (in addition to "hexdigest", which is for
+            "hash_method"); a digest of None is computed (see Downloader.digests) but not verified
+        :param check_length: fail as soon as more data than the expected length ("content_length", or else the
+            Content-Length header) is received, and fail if less is received
+        :param min_segment_size: with "stream" and more than one "concurrent_download", files of at least twice
+            that size are fetched in segments over several connections, if the server supports Range requests;
+            segments are never split below that size
+        :param resume: with "stream", keep the partial file of an interrupted download, along with the hashes of its
+            chunks of "min_segment_size" bytes, and only fetch the missing or corrupt chunks on the next attempt;
+            the server must support Range requests, and send an ETag or Last-Modified header
+        :param cache: DownloadCache to look the file up in before downloading it, and to add it to once downloaded;
+            only used when an expected digest is given, the cached file is checked against every expected digest
+        """
+
+        self.pool = get_shared_pool('download', concurrent_download)
         self.url = url
         self.filename = filename
         self.content_length = content_length
         self.max_download_retries = download_retries
         self.block_size = block_size
-        self.http_pool = get_http_pool()
+        self.http_pool = worker_resource('http_pool', get_http_pool)
         self.hexdigest = hexdigest
         self.file_binary_data = None
+        self.concurrent_download = concurrent_download
+        self.min_segment_size = min_segment_size
+        self.resume = resume
+        self.cache = cache
 
         if progress_hooks is not None and not isinstance(progress_hooks, list):
             raise TypeError(type(progress_hooks))
         self.progress_hooks = progress_hooks or []
 
         self.hash_method = hash_method
+        self.stream = stream
+        self.check_length = check_length
+        self.expected_length = content_length
+
+        self.hexdigests = dict(hexdigests or {})
+        if hexdigest is not None:
+            self.hexdigests[hash_method] = hexdigest
+        for method in self.hexdigests:
+            _new_hash(method)
+        # Digests of the downloaded data, computed block by block
+        self.digests = None
 
     def _write_to_file(self):
 
+        # The file may be hardlinked to a DownloadCache entry, that must not be overwritten
+        self._remove(str(self.filename))
         with open(self.filename, 'wb') as f:
             f.write(self.file_binary_data)
 
+    @property
+    def temp_filename(self) -> str:
+        return '{}.part'.format(self.filename)
+
+    @property
+    def state_filename(self) -> str:
+        return '{}.json'.format(self.temp_filename)
+
     def _check_hash(self):
 
-        if self.hexdigest is None:
+        if not any(self.hexdigests.values()):
             logger.debug('no hash to verify')
             return None
 
-        if self.file_binary_data is None:
+        if self.digests is None:
             logger.debug('cannot verify file hash')
             return False
 
         logger.debug('checking file hash')
-        logger.debug('update hash: %s', self.hexdigest)
-
-        file_hash = get_hash(self.file_binary_data, self.hash_method)
 
-        if file_hash == self.hexdigest:
-            logger.debug('file hash verified')
-            return True
+        for method, hexdigest in self.hexdigests.items():
+            if hexdigest is None:
+                continue
+            logger.debug('update hash (%s): %s', method, hexdigest)
+            if self.digests[method] != hexdigest.lower():
+                logger.debug('cannot verify file hash')
+                return False
 
-        logger.debug('cannot verify file hash')
-        return False
+        logger.debug('file hash verified')
+        return True
 
     @staticmethod
     def _calc_eta(start, now, total, current):
@@ -195,6 +685,23 @@ class Downloader:
         if data is None:
             return None
 
+        buffer = bytearray()
+        if self._read_response(data, buffer.extend) is False:
+            return False
+        self.file_binary_data = bytes(buffer)
+
+    def _download_to_file(self):
+
+        data = self._create_response()
+
+        if data is None:
+            return None
+
+        with open(self.temp_filename, 'wb') as f:
+            return self._read_response(data, f.write)
+
+    def _read_response(self, data, write: callable):
+
         self.content_length = self._get_content_length(data)
 
         if self.content_length is None:
@@ -203,14 +710,30 @@ class Downloader:
                          'or percent downloaded.')
 
         received_data = 0
+        cancel_token = current_cancel_token()
+        hashes = [(method, _new_hash(method)) for method in self.hexdigests]
+        max_length = self.expected_length if self.expected_length is not None else self.content_length
+        self.digests = None
 
         start_download = time.time()
         block = data.read(1)
         received_data += len(block)
-        self.file_binary_data = block
+        write(block)
+        for _, hash_ in hashes:
+            hash_.update(block)
         percent = self._calc_progress_percent(0, self.content_length)
         while 1:
 
+            if cancel_token.is_cancelled:
+                logger.debug('download cancelled')
+                data.release_conn()
+                return False
+
+            if self.check_length and max_length is not None and received_data > max_length:
+                logger.error('received more than the expected %s bytes, aborting download', max_length)
+                data.release_conn()
+                return False
+
             start_block = time.time()
 
             block = data.read(self.block_size)
@@ -223,7 +746,9 @@ class Downloader:
             self.block_size = self._best_block_size(end_block - start_block,
                                                     len(block))
             logger.debug('Block size: %s', self.block_size)
-            self.file_binary_data += block
+            write(block)
+            for _, hash_ in hashes:
+                hash_.update(block)
 
             received_data += len(block)
 
@@ -242,6 +767,12 @@ class Downloader:
 
             self._call_progress_hooks(status)
 
+        if self.check_length and max_length is not None and received_data != max_length:
+            logger.error('received %s bytes, expected %s', received_data, max_length)
+            return False
+
+        self.digests = {method: hash_.hexdigest() for method, hash_ in hashes}
+
         status = {'total': self.content_length,
                   'downloaded': received_data,
                   'status': 'finished',
@@ -250,24 +781,263 @@ class Downloader:
 
         self._call_progress_hooks(status)
         logger.debug('Download Complete')
+        return True
+
+    @staticmethod
+    def _remove(path: str):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _probe_ranges(self):
+        """
+        :return: size and validators (ETag, Last-Modified) of the file if the server accepts Range requests for it,
+            None otherwise
+        """
+        try:
+            response = self.http_pool.urlopen('HEAD', self.url, retries=self.max_download_retries)
+        except Exception as e:
+            logger.debug(str(e), exc_info=True)
+            return None
+
+        if response.status != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            logger.debug('server does not accept Range requests')
+            return None
+
+        total = self._get_content_length(response)
+        if total is None:
+            return None
+
+        return total, {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+    def _save_state(self, state: dict):
+
+        temp = '{}.tmp'.format(self.state_filename)
+        try:
+            with open(temp, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp, self.state_filename)
+        except OSError:
+            logger.exception('cannot save the state of the download to %s', self.state_filename)
+
+    def _load_state(self, total: int, validators: dict):
+        """
+        Reads the state of a previous attempt at the download, and checks the chunks it wrote
+        :return: segments that are missing or corrupt, and hashes of the valid chunks; None if there is nothing to
+            resume
+        """
+        try:
+            with open(self.state_filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (state.get('url') != self.url or state.get('size') != total or state.get('validators') != validators
+                or state.get('chunk_size') != self.min_segment_size
+                or not os.path.exists(self.temp_filename) or os.path.getsize(self.temp_filename) != total):
+            logger.debug('cannot resume download, the file changed')
+            return None
+
+        chunk_size = self.min_segment_size
+        chunks = {}
+        with open(self.temp_filename, 'rb') as f:
+            for index, hexdigest in state.get('chunks', {}).items():
+                index = int(index)
+                f.seek(index * chunk_size)
+                if hashlib.md5(f.read(chunk_size)).hexdigest() == hexdigest:
+                    chunks[index] = hexdigest
+                else:
+                    logger.debug('chunk %s is corrupt', index)
+
+        segments = []
+        for start in range(0, total, chunk_size):
+            if start // chunk_size in chunks:
+                continue
+            end = min(start + chunk_size, total)
+            if segments and segments[-1].end == start:
+                segments[-1].end = end
+            else:
+                segments.append(_Segment(start, end))
+        return segments, chunks
+
+    def _initial_segments(self, total: int) -> list:
+
+        count = max(min(self.concurrent_download, total // self.min_segment_size), 1)
+        size = -(-total // count)
+        # Segments start on a chunk boundary
+        size = max(size + -size % self.min_segment_size, self.min_segment_size)
+        return [_Segment(start, min(start + size, total)) for start in range(0, total, size)]
+
+    def _hash_file(self, path: str):
+
+        hashes = [(method, _new_hash(method)) for method in self.hexdigests]
+        if hashes:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(4096 * 16), b''):
+                    for _, hash_ in hashes:
+                        hash_.update(block)
+        self.digests = {method: hash_.hexdigest() for method, hash_ in hashes}
+
+    def _download_segmented(self):
+
+        probe = None
+        if self.concurrent_download > 1 or self.resume:
+            probe = self._probe_ranges()
+
+        total, validators = probe or (None, None)
+        resumable = self.resume and total is not None and _if_range(validators) is not None
+        # Without validators, a partial file cannot be resumed: "resume" alone is no reason for Range requests
+        split = self.concurrent_download > 1 and total is not None and total >= 2 * self.min_segment_size
+        if not (resumable or split):
+            self._remove(self.state_filename)
+            return self._download_to_file()
+
+        if self.check_length and self.expected_length is not None and total != self.expected_length:
+            logger.error('file is %s bytes, expected %s', total, self.expected_length)
+            return False
+
+        self.content_length = total
+        self.digests = None
+
+        state = self._load_state(total, validators) if resumable else None
+        if state is None:
+            self._remove(self.state_filename)
+            segments, chunks = self._initial_segments(total), None
+            with open(self.temp_filename, 'wb') as f:
+                f.truncate(total)
+        else:
+            segments, chunks = state
+            logger.info('resuming download of %s, %s bytes left', self.url,
+                        sum(segment.remaining for segment in segments))
+        logger.debug('downloading %s bytes in %s segments', total, len(segments))
+
+        # A fresh download over a single connection writes the file in order: it is hashed as it is written
+        hashes = None
+        if state is None and len(segments) == 1 and self.concurrent_download == 1:
+            hashes = [(method, _new_hash(method)) for method in self.hexdigests]
+        download = _RangedDownload(self, self.temp_filename, total, segments, validators if resumable else None,
+                                   chunks, hashes)
+        if not download.run(self.pool):
+            if download.unsupported and not download.cancel_token.is_cancelled:
+                logger.debug('server sent the whole file, downloading with a single request')
+                self._remove(self.state_filename)
+                return self._download_to_file()
+            return False
+
+        self._remove(self.state_filename)
+
+        self.digests = download.digests
+        if self.digests is None:
+            # Segments arrived out of order, or part of the file was written by a previous attempt: the digests
+            # need a pass over the complete file
+            self._hash_file(self.temp_filename)
+
+        self._call_progress_hooks({'total': total,
+                                   'downloaded': total,
+                                   'status': 'finished',
+                                   'percent_complete': self._calc_progress_percent(total, total),
+                                   'time': '00:00'})
+        logger.debug('Download Complete')
+        return True
+
+    def _discard_partial(self):
+
+        if self.resume and os.path.exists(self.state_filename):
+            logger.info('keeping %s to resume the download later', self.temp_filename)
+            return
+        self._remove(self.temp_filename)
+
+    def _download_streaming(self):
+
+        logger.debug('downloading to %s', self.temp_filename)
+        try:
+            result = self._download_segmented()
+        except Exception:
+            self._discard_partial()
+            raise
+        if result is not True:
+            self._discard_partial()
+            return False
+
+        if self._check_hash() is False:
+            self._remove(self.temp_filename)
+            self._remove(self.state_filename)
+            self._remove(str(self.filename))
+            return False
+
+        logger.debug('moving %s to %s', self.temp_filename, self.filename)
+        os.replace(self.temp_filename, str(self.filename))
+        self._add_to_cache()
+        return True
+
+    def _cache_key(self):
+        """
+        :return: hash method and expected digest the file is cached under, None if no digest is expected
+        """
+        expected = {method: hexdigest for method, hexdigest in self.hexdigests.items() if hexdigest}
+        if self.cache is None or not expected:
+            return None
+        method = self.hash_method if self.hash_method in expected else sorted(expected)[0]
+        return method, expected[method]
+
+    def _download_from_cache(self) -> bool:
+
+        key = self._cache_key()
+        if key is None:
+            return False
+        blob = self.cache.get(*key)
+        if blob is None:
+            return False
+
+        size = os.path.getsize(blob)
+        self._hash_file(blob)
+        if self._check_hash() is not True or (self.check_length and self.expected_length not in (None, size)):
+            logger.warning('cached file %s is corrupt, removing it', blob)
+            self.cache.remove(*key)
+            self.digests = None
+            return False
+
+        if not self.cache.materialize(blob, str(self.filename)):
+            return False
+
+        self._call_progress_hooks({'total': size,
+                                   'downloaded': size,
+                                   'status': 'finished',
+                                   'percent_complete': self._calc_progress_percent(size, size),
+                                   'time': '00:00'})
+        logger.debug('Download served from the cache')
+        return True
+
+    def _add_to_cache(self):
+
+        key = self._cache_key()
+        if key is not None:
+            self.cache.put(str(self.filename), *key)
 
     def download(self):
 
+        if self._download_from_cache():
+            return True
+
+        if self.stream:
+            return self._download_streaming()
+
         logger.debug('downloading to memory')
-        self._download_to_memory()
+        if self._download_to_memory() is False:
+            return False
 
         check = self._check_hash()
 
         if check is True or check is None:
             logger.debug('writing to file')
             self._write_to_file()
+            if check is True:
+                self._add_to_cache()
             return True
 
         else:
             del self.file_binary_data
-            if os.path.exists(self.filename):
-                try:
-                    os.remove(self.filename)
-                except OSError:
-                    pass
+            self._remove(str(self.filename))
             return False
@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+Performance benchmarks for utils.downloader
+
+Not collected by pytest; run with:
+
+    python -m utils.tests.bench_downloader [--size MB] [--connections 1,2,4,8] [--output report.json]
+
+Serves a file from a local HTTP server that throttles every connection, the way a remote server (or the network
+path to it) usually does, and times the download with an increasing number of concurrent connections.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from utils.downloader import Downloader
+from utils.tests.file_server import FileHandler, start_file_server
+
+
+def bench_ranged_download(size: int, connections: tuple = (1, 2, 4, 8), chunk_delay: float = 0.005,
+                          rounds: int = 3) -> dict:
+    """
+    Measures the throughput of a download against the number of connections it uses
+    :param size: size of the file, in bytes
+    :param connections: numbers of concurrent connections to time
+    :param chunk_delay: seconds the server sleeps after sending each 64 KB chunk, on every connection
+    :param rounds: number of downloads to time for each number of connections; the best one is kept
+    """
+    FileHandler.files['/bench'] = os.urandom(size)
+    FileHandler.delays['/bench'] = lambda _: chunk_delay
+    server, base_url = start_file_server()
+    url = base_url + '/bench'
+
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, 'bench')
+            for connection_count in connections:
+                timings = []
+                for _ in range(rounds):
+                    start = time.perf_counter()
+                    if not Downloader(url, dest, stream=True, concurrent_download=connection_count,
+                                      min_segment_size=256 * 1024).download():
+                        raise RuntimeError('download failed')
+                    timings.append(time.perf_counter() - start)
+                best = min(timings)
+                results['connections_{}'.format(connection_count)] = {
+                    'download_s': best,
+                    'mb_per_s': size / best / 1024 / 1024,
+                }
+    finally:
+        server.shutdown()
+        server.server_close()
+        del FileHandler.files['/bench']
+        del FileHandler.delays['/bench']
+    return results
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='utils.downloader benchmarks')
+    parser.add_argument('--size', type=int, default=16, help='size of the file, in MB')
+    parser.add_argument('--connections', default='1,2,4,8', help='comma-separated numbers of connections')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args(argv)
+
+    connections = tuple(int(count) for count in args.connections.split(','))
+    results = bench_ranged_download(args.size * 1024 * 1024, connections)
+    for name, result in results.items():
+        print('{}: {}'.format(name, result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,369 @@
+# coding=utf-8
+"""
+Performance benchmarks for utils.threadpool
+
+Not collected by pytest; run with:
+
+    python -m utils.tests.bench_threadpool [--quick] [--output report.json] [--baseline baseline.json]
+
+With --output, writes a JSON report of every measurement; with --baseline, compares the measurements to a
+previous report and exits with status 1 if any of them got worse by more than --tolerance.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+from utils.threadpool import ThreadPool
+
+
+def _summarize(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        'samples': len(samples),
+        'min_ms': samples[0] * 1000,
+        'median_ms': statistics.median(samples) * 1000,
+        'p99_ms': samples[int(len(samples) * 0.99) - 1] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def bench_dispatch_latency(thread_count: int = 4, samples: int = 200, idle_gap: float = 0.005) -> dict:
+    """
+    Measures the delay between queuing a task on an idle pool and the task actually starting
+    :param thread_count: number of threads in the pool
+    :param samples: number of tasks to time
+    :param idle_gap: time to leave the pool idle between two samples
+    """
+    pool = ThreadPool(thread_count, 'bench', True)
+    started = threading.Event()
+    start_times = []
+
+    def task():
+        start_times.append(time.perf_counter())
+        started.set()
+
+    latencies = []
+    for _ in range(samples):
+        time.sleep(idle_gap)
+        started.clear()
+        queued_at = time.perf_counter()
+        pool.queue_task(task)
+        started.wait()
+        latencies.append(start_times[-1] - queued_at)
+
+    pool.join_all(False, False)
+    return _summarize(latencies)
+
+
+def bench_throughput(thread_count: int = 4, task_count: int = 100000) -> dict:
+    """
+    Measures the time needed to queue, then drain, a large backlog of no-op tasks
+    :param thread_count: number of threads in the pool
+    :param task_count: number of tasks to queue
+    """
+    pool = ThreadPool(0, 'bench', True)
+    done = threading.Event()
+    remaining = [task_count]
+    lock = threading.Lock()
+
+    def noop():
+        pass
+
+    def callback(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+    start = time.perf_counter()
+    for _ in range(task_count):
+        pool.queue_task(noop, _task_callback=callback)
+    queued = time.perf_counter()
+    pool.set_thread_count(thread_count)
+    done.wait()
+    drained = time.perf_counter()
+
+    pool.join_all(False, False)
+    return {
+        'tasks': task_count,
+        'threads': thread_count,
+        'enqueue_s': queued - start,
+        'drain_s': drained - queued,
+        'tasks_per_s': task_count / (drained - start),
+    }
+
+
+def bench_priority_latency(thread_count: int = 4, bulk_count: int = 4000, samples: int = 100,
+                           bulk_duration: float = 0.001, priority: int = 1) -> dict:
+    """
+    Measures the queue-to-start latency of urgent tasks while the pool is saturated with bulk work
+    :param thread_count: number of threads in the pool
+    :param bulk_count: number of bulk tasks queued before the urgent ones
+    :param samples: number of urgent tasks to time
+    :param bulk_duration: duration of a single bulk task
+    :param priority: priority of the urgent tasks (bulk tasks run at priority 0)
+    """
+    pool = ThreadPool(thread_count, 'bench', True)
+    latencies = []
+    done = threading.Event()
+
+    def urgent(queued_at):
+        latencies.append(time.perf_counter() - queued_at)
+        if len(latencies) == samples:
+            done.set()
+
+    for _ in range(bulk_count):
+        pool.queue_task(time.sleep, [bulk_duration])
+    for _ in range(samples):
+        pool.queue_task(urgent, [time.perf_counter()], _priority=priority)
+        time.sleep(bulk_duration)
+    done.wait()
+
+    pool.join_all(False, False)
+    return _summarize(latencies)
+
+
+def bench_contention(thread_count: int = 32, root_count: int = 64, fan_out: int = 500,
+                     work_stealing: bool = False) -> dict:
+    """
+    Measures the throughput of a pool where tasks queue many short tasks themselves (fan-out), which makes
+    every thread hit the pool's locks at a high rate
+    :param thread_count: number of threads in the pool
+    :param root_count: number of tasks queued from outside the pool
+    :param fan_out: number of no-op tasks queued by each root task
+    :param work_stealing: use the work-stealing variant of the pool
+    """
+    pool = ThreadPool(thread_count, 'bench', True, _work_stealing=work_stealing)
+    task_count = root_count * (fan_out + 1)
+    done = threading.Event()
+    # next() on a count is atomic: a lock here would be the main source of contention
+    finished = itertools.count(1)
+
+    def leaf():
+        if next(finished) == task_count:
+            done.set()
+
+    def root():
+        for _ in range(fan_out):
+            pool.queue_task(leaf)
+        leaf()
+
+    start = time.perf_counter()
+    for _ in range(root_count):
+        pool.queue_task(root)
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    pool.join_all(False, False)
+    return {
+        'tasks': task_count,
+        'threads': thread_count,
+        'work_stealing': work_stealing,
+        'elapsed_s': elapsed,
+        'tasks_per_s': task_count / elapsed,
+    }
+
+
+def bench_enqueue(task_count: int = 100000) -> dict:
+    """
+    Measures how fast tasks can be queued, with no thread taking them
+    :param task_count: number of tasks to queue
+    """
+    pool = ThreadPool(0, 'bench', True)
+
+    def noop():
+        pass
+
+    start = time.perf_counter()
+    for _ in range(task_count):
+        pool.queue_task(noop)
+    elapsed = time.perf_counter() - start
+
+    pool.join_all(False, False)
+    return {
+        'tasks': task_count,
+        'enqueue_s': elapsed,
+        'tasks_per_s': task_count / elapsed,
+    }
+
+
+def bench_drain(thread_counts: tuple = (1, 2, 4, 8, 16, 32), task_count: int = 20000) -> dict:
+    """
+    Measures the time needed by pools of various sizes to run a backlog of no-op tasks
+    :param thread_counts: pool sizes to measure
+    :param task_count: number of tasks in the backlog
+    """
+    results = {}
+    for thread_count in thread_counts:
+        pool = ThreadPool(0, 'bench', True)
+        for _ in range(task_count):
+            pool.queue_task(abs, [-1])
+        start = time.perf_counter()
+        pool.set_thread_count(thread_count)
+        pool.wait()
+        elapsed = time.perf_counter() - start
+        pool.join_all(False, False)
+        results['threads_{}'.format(thread_count)] = {
+            'drain_s': elapsed,
+            'tasks_per_s': task_count / elapsed,
+        }
+    return results
+
+
+def bench_callback_overhead(thread_count: int = 4, task_count: int = 50000) -> dict:
+    """
+    Measures the cost, per task, of a result callback and of a Future, compared to a bare task
+    :param thread_count: number of threads in the pool
+    :param task_count: number of tasks per measurement
+    """
+
+    def noop(_=None):
+        pass
+
+    def drain(queue):
+        pool = ThreadPool(0, 'bench', True)
+        for _ in range(task_count):
+            queue(pool)
+        start = time.perf_counter()
+        pool.set_thread_count(thread_count)
+        pool.wait()
+        elapsed = time.perf_counter() - start
+        pool.join_all(False, False)
+        return elapsed
+
+    bare = drain(lambda pool: pool.queue_task(noop))
+    callback = drain(lambda pool: pool.queue_task(noop, _task_callback=noop))
+    future = drain(lambda pool: pool.submit(noop))
+    return {
+        'tasks': task_count,
+        'bare_us': bare / task_count * 1e6,
+        'callback_overhead_us': (callback - bare) / task_count * 1e6,
+        'future_overhead_us': (future - bare) / task_count * 1e6,
+    }
+
+
+def bench_resize(thread_count: int = 32, rounds: int = 10) -> dict:
+    """
+    Measures the time needed to grow an idle pool from 0 to "thread_count" threads, and to shrink it back
+    :param thread_count: number of threads to start and stop
+    :param rounds: number of grow/shrink cycles
+    """
+    pool = ThreadPool(0, 'bench', True)
+    grow = []
+    shrink = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        pool.set_thread_count(thread_count)
+        grow.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        pool.set_thread_count(0)
+        shrink.append(time.perf_counter() - start)
+    pool.join_all()
+    return {
+        'threads': thread_count,
+        'grow_ms': statistics.median(grow) * 1000,
+        'shrink_ms': statistics.median(shrink) * 1000,
+        'grow_per_thread_us': statistics.median(grow) / thread_count * 1e6,
+    }
+
+
+def run_all(quick: bool = False) -> dict:
+    """
+    Runs every benchmark
+    :param quick: run smaller workloads, for a fast but noisier report
+    :return: report, with a "results" entry per benchmark
+    """
+    scale = 10 if quick else 1
+    results = {
+        'enqueue': bench_enqueue(100000 // scale),
+        'dispatch_latency': bench_dispatch_latency(samples=200 // scale),
+        'throughput': bench_throughput(task_count=100000 // scale),
+        'drain': bench_drain(task_count=20000 // scale),
+        'callback_overhead': bench_callback_overhead(task_count=50000 // scale),
+        'resize': bench_resize(rounds=10 // scale or 1),
+        'priority_latency_fifo': bench_priority_latency(bulk_count=4000 // scale, samples=100 // scale, priority=0),
+        'priority_latency_prioritized': bench_priority_latency(bulk_count=4000 // scale, samples=100 // scale),
+    }
+    for thread_count in (32, 64):
+        for work_stealing in (False, True):
+            name = 'contention_{}_{}'.format(thread_count, 'work_stealing' if work_stealing else 'shared_queue')
+            results[name] = bench_contention(thread_count, root_count=64 // scale, work_stealing=work_stealing)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def _flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, '{}{}.'.format(prefix, key)))
+        elif isinstance(value, float):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.25) -> list:
+    """
+    Lists the measurements that got worse than in a baseline report
+
+    Rates ("per_s") are expected not to decrease, and durations ("_s", "_ms", "_us") not to increase, by more
+    than "tolerance" (a fraction of the baseline). Extremes ("min_", "max_") are too noisy, and are not compared.
+    :return: list of (measurement, baseline value, new value)
+    """
+    regressions = []
+    new = _flatten(report['results'])
+    for name, old_value in sorted(_flatten(baseline['results']).items()):
+        value = new.get(name)
+        if value is None or old_value <= 0 or name.rpartition('.')[2].startswith(('min_', 'max_')):
+            continue
+        if name.endswith('per_s'):
+            worse = value < old_value * (1 - tolerance)
+        elif name.endswith(('_s', '_ms', '_us')):
+            worse = value > old_value * (1 + tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append((name, old_value, value))
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='utils.threadpool benchmarks')
+    parser.add_argument('--quick', action='store_true', help='run smaller workloads')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--baseline', help='compare to this JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='accepted slowdown, as a fraction')
+    args = parser.parse_args(argv)
+
+    report = run_all(args.quick)
+    for name, result in report['results'].items():
+        print('{}: {}'.format(name, result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for name, old_value, value in regressions:
+            print('REGRESSION {}: {:.6g} -> {:.6g}'.format(name, old_value, value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# coding=utf-8
+"""
+Local HTTP server serving files from memory, for the downloader tests and benchmarks
+
+FileHandler serves the content of FileHandler.files; the other class attributes, keyed by path, make it ignore
+Range requests, throttle or cut short its responses.
+"""
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    files = {}
+    # Paths for which Range requests are ignored
+    no_ranges = set()
+    # Functions giving the number of seconds to sleep after each chunk of a response, from its first byte, by path
+    delays = {}
+    # Number of bytes after which responses are cut short, by path
+    cuts = {}
+    # (method, path, Range header) of every request
+    requests = []
+    # (content, ETag) by path
+    etags = {}
+    # Paths for which no ETag is sent
+    no_validators = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._send(body=False)
+
+    def do_GET(self):
+        self._send()
+
+    def _send(self, body: bool = True):
+        content = self.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        range_ = self.headers.get('Range')
+        self.requests.append((self.command, self.path, range_))
+
+        cached_content, etag = self.etags.get(self.path, (None, None))
+        if cached_content is not content:
+            etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+            self.etags[self.path] = content, etag
+        if_range = self.headers.get('If-Range')
+
+        start, end = 0, len(content)
+        ranges = self.path not in self.no_ranges
+        if ranges and range_ is not None and if_range in (None, etag):
+            first, last = range_.split('=')[1].split('-')
+            start, end = int(first), int(last) + 1 if last else len(content)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(content)))
+        else:
+            self.send_response(200)
+        if ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if self.path not in self.no_validators:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if not body:
+            return
+
+        delay = self.delays.get(self.path, lambda _: 0)(start)
+        end = min(end, start + self.cuts.get(self.path, end))
+        try:
+            for offset in range(start, end, 64 * 1024):
+                self.wfile.write(content[offset:min(offset + 64 * 1024, end)])
+                if delay:
+                    time.sleep(delay)
+        except ConnectionError:
+            pass
+
+
+def start_file_server() -> tuple:
+    """
+    Starts a FileHandler server on a free local port, in a daemon thread
+    :return: the server (to shut down and close once done), and its base URL
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
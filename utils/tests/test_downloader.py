@@ -1,7 +1,13 @@
 # coding=utf-8
+import hashlib
+import json
+import os
+import time
+
 import pytest
 from utils import Downloader, create_temp_file
-from utils.downloader import get_hash
+from utils.downloader import DownloadCache, get_hash
+from utils.tests.file_server import FileHandler, start_file_server
 
 SMALL = r'http://download.thinkbroadband.com/1MB.zip'
 NOPE = r'http://download.thinkbroadband.com/nope.zip'
@@ -54,3 +60,244 @@ def test_wrong_url(tmpdir):
     success = Downloader(NOPE, dest, hexdigest='wrong_digest').download()
     assert not success
 
+
+@pytest.fixture(scope='module')
+def http_server():
+    server, url = start_file_server()
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='module')
+def payload():
+    content = os.urandom(1024 * 1024 + 123)
+    FileHandler.files['/payload'] = content
+    return content
+
+
+def test_stream_to_disk(tmpdir, http_server, payload):
+    dest = str(tmpdir.join('payload'))
+    downloader = Downloader(http_server + '/payload', dest, hexdigest=hashlib.md5(payload).hexdigest(), stream=True)
+    assert downloader.download() is True
+    assert downloader.file_binary_data is None
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert not os.path.exists(downloader.temp_filename)
+
+
+def test_stream_wrong_digest(tmpdir, http_server, payload):
+    dest = tmpdir.join('payload')
+    dest.write('previous')
+    downloader = Downloader(http_server + '/payload', str(dest), hexdigest='wrong_digest', stream=True)
+    assert downloader.download() is False
+    assert not dest.exists()
+    assert not os.path.exists(downloader.temp_filename)
+
+
+def test_stream_wrong_url(tmpdir, http_server):
+    dest = str(tmpdir.join('nope'))
+    assert Downloader(http_server + '/nope', dest, hexdigest='wrong_digest', stream=True).download() is False
+    assert not os.path.exists(dest)
+
+
+def test_multiple_digests(tmpdir, http_server, payload):
+    dest = str(tmpdir.join('payload'))
+    hexdigests = {'md5': hashlib.md5(payload).hexdigest(), 'sha256': hashlib.sha256(payload).hexdigest(), 'sha1': None}
+    downloader = Downloader(http_server + '/payload', dest, hexdigests=hexdigests, stream=True)
+    assert downloader.download() is True
+    assert downloader.digests['sha1'] == hashlib.sha1(payload).hexdigest()
+
+    hexdigests['sha256'] = 'wrong_digest'
+    assert Downloader(http_server + '/payload', dest, hexdigests=hexdigests).download() is False
+    assert not os.path.exists(dest)
+
+    with pytest.raises(RuntimeError):
+        Downloader(http_server + '/payload', dest, hexdigests={'nope': None})
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_check_length(tmpdir, http_server, payload, stream):
+    dest = str(tmpdir.join('payload'))
+    url = http_server + '/payload'
+    assert Downloader(url, dest, content_length=len(payload), check_length=True, stream=stream).download() is True
+    too_long = Downloader(url, dest, content_length=1000, check_length=True, stream=stream, block_size=100)
+    assert too_long.download() is False
+    assert too_long.digests is None
+    assert Downloader(url, dest, content_length=len(payload) + 1, check_length=True, stream=stream).download() is False
+
+
+def _ranges(path: str) -> list:
+    return [range_ for method, path_, range_ in FileHandler.requests if method == 'GET' and path_ == path]
+
+
+def test_ranged_download(tmpdir, http_server, payload):
+    FileHandler.requests.clear()
+    dest = str(tmpdir.join('payload'))
+    hooks = []
+    downloader = Downloader(http_server + '/payload', dest, hexdigest=hashlib.md5(payload).hexdigest(), stream=True,
+                            concurrent_download=4, min_segment_size=128 * 1024, progress_hooks=[hooks.append])
+    assert downloader.download() is True
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert not os.path.exists(downloader.temp_filename)
+    assert len(_ranges('/payload')) >= 4
+    assert hooks[-1]['status'] == 'finished'
+    assert hooks[-1]['downloaded'] == len(payload)
+
+    # Too small to be split
+    FileHandler.requests.clear()
+    assert Downloader(http_server + '/payload', dest, stream=True, concurrent_download=4).download() is True
+    assert _ranges('/payload') == [None]
+
+
+def test_ranged_resplit(tmpdir, http_server, payload):
+    FileHandler.files['/slow'] = payload
+    # The connection fetching the start of the file is much slower than the others
+    FileHandler.delays['/slow'] = lambda start: 0.05 if start == 0 else 0
+    FileHandler.requests.clear()
+    dest = str(tmpdir.join('payload'))
+    downloader = Downloader(http_server + '/slow', dest, hexdigest=hashlib.md5(payload).hexdigest(), stream=True,
+                            concurrent_download=2, min_segment_size=64 * 1024)
+    assert downloader.download() is True
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert len(_ranges('/slow')) > 2
+
+
+def test_ranged_not_supported(tmpdir, http_server, payload):
+    FileHandler.files['/no_ranges'] = payload
+    FileHandler.no_ranges.add('/no_ranges')
+    FileHandler.requests.clear()
+    dest = str(tmpdir.join('payload'))
+    downloader = Downloader(http_server + '/no_ranges', dest, hexdigest=hashlib.md5(payload).hexdigest(),
+                            stream=True, concurrent_download=4, min_segment_size=128 * 1024)
+    assert downloader.download() is True
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert _ranges('/no_ranges') == [None]
+
+
+def test_resume(tmpdir, http_server, payload):
+    FileHandler.files['/resume'] = payload
+    FileHandler.cuts['/resume'] = 600 * 1024
+    dest = str(tmpdir.join('payload'))
+    url = http_server + '/resume'
+    chunk = 128 * 1024
+    options = dict(hexdigest=hashlib.md5(payload).hexdigest(), stream=True, resume=True, min_segment_size=chunk,
+                   download_retries=0)
+
+    downloader = Downloader(url, dest, **options)
+    assert downloader.download() is False
+    assert os.path.exists(downloader.temp_filename)
+    with open(downloader.state_filename) as f:
+        saved = sorted(int(index) for index in json.load(f)['chunks'])
+    assert len(saved) >= 2
+    assert saved == list(range(len(saved)))
+
+    # Corrupt the first chunk: it is fetched again, along with everything after the second chunk
+    with open(downloader.temp_filename, 'r+b') as f:
+        f.write(b'corrupt')
+    del FileHandler.cuts['/resume']
+    FileHandler.requests.clear()
+    assert Downloader(url, dest, **options).download() is True
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert _ranges('/resume') == ['bytes=0-{}'.format(chunk - 1),
+                                  'bytes={}-{}'.format(len(saved) * chunk, len(payload) - 1)]
+    assert not os.path.exists(downloader.temp_filename)
+    assert not os.path.exists(downloader.state_filename)
+
+
+def test_resume_changed_file(tmpdir, http_server, payload):
+    FileHandler.files['/changed'] = payload
+    FileHandler.cuts['/changed'] = 300 * 1024
+    dest = str(tmpdir.join('payload'))
+    url = http_server + '/changed'
+    options = dict(stream=True, resume=True, min_segment_size=128 * 1024, download_retries=0)
+    assert Downloader(url, dest, **options).download() is False
+
+    del FileHandler.cuts['/changed']
+    FileHandler.files['/changed'] = new_payload = os.urandom(len(payload))
+    FileHandler.requests.clear()
+    assert Downloader(url, dest, hexdigest=hashlib.md5(new_payload).hexdigest(), **options).download() is True
+    with open(dest, 'rb') as f:
+        assert f.read() == new_payload
+    assert _ranges('/changed') == ['bytes=0-{}'.format(len(payload) - 1)]
+
+
+def test_resume_hashes_while_writing(tmpdir, http_server, payload, mocker):
+    FileHandler.requests.clear()
+    dest = str(tmpdir.join('payload'))
+    hexdigests = {'md5': hashlib.md5(payload).hexdigest(), 'sha1': None}
+    hash_file = mocker.spy(Downloader, '_hash_file')
+    downloader = Downloader(http_server + '/payload', dest, hexdigests=hexdigests, stream=True, resume=True,
+                            min_segment_size=128 * 1024)
+    assert downloader.download() is True
+    assert _ranges('/payload') == ['bytes=0-{}'.format(len(payload) - 1)]
+    assert downloader.digests['sha1'] == hashlib.sha1(payload).hexdigest()
+    # The digests were computed as the file was written, without reading it again
+    hash_file.assert_not_called()
+
+
+def test_resume_without_validators(tmpdir, http_server, payload):
+    FileHandler.files['/no_validators'] = payload
+    FileHandler.no_validators.add('/no_validators')
+    FileHandler.requests.clear()
+    dest = str(tmpdir.join('payload'))
+    downloader = Downloader(http_server + '/no_validators', dest, hexdigest=hashlib.md5(payload).hexdigest(),
+                            stream=True, resume=True, min_segment_size=128 * 1024)
+    assert downloader.download() is True
+    assert _ranges('/no_validators') == [None]
+    assert not os.path.exists(downloader.state_filename)
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_cache(tmpdir, http_server, payload, stream):
+    cache = DownloadCache(str(tmpdir.join('cache')))
+    md5 = hashlib.md5(payload).hexdigest()
+    dest = str(tmpdir.join('payload'))
+    assert Downloader(http_server + '/payload', dest, hexdigest=md5, cache=cache, stream=stream).download() is True
+    assert os.path.exists(cache.blob_path('md5', md5))
+
+    # Served from the cache, the URL is not even valid
+    FileHandler.requests.clear()
+    other = str(tmpdir.join('other'))
+    hooks = []
+    assert Downloader(http_server + '/nope', other, hexdigest=md5.upper(), cache=cache, stream=stream,
+                      progress_hooks=[hooks.append]).download() is True
+    assert FileHandler.requests == []
+    assert hooks[-1]['status'] == 'finished'
+    with open(other, 'rb') as f:
+        assert f.read() == payload
+
+    # Overwriting a downloaded file does not alter the cache
+    assert Downloader(http_server + '/payload', dest, cache=cache, stream=stream).download() is True
+    assert Downloader(http_server + '/nope', other, hexdigest=md5, cache=cache).download() is True
+
+    # A corrupt entry is dropped, and the file downloaded again
+    with open(cache.blob_path('md5', md5), 'r+b') as f:
+        f.write(b'corrupt')
+    assert Downloader(http_server + '/nope', other, hexdigest=md5, cache=cache).download() is False
+    assert not os.path.exists(cache.blob_path('md5', md5))
+    assert Downloader(http_server + '/payload', dest, hexdigest=md5, cache=cache, stream=stream).download() is True
+    assert len(_ranges('/payload')) == 2
+
+
+def test_cache_eviction(tmpdir):
+    cache = DownloadCache(str(tmpdir.join('cache')), max_size=250)
+    for name, age in (('a', 20), ('b', 10)):
+        path = tmpdir.join(name)
+        path.write(name * 100)
+        assert cache.put(str(path), 'md5', name) is True
+        os.utime(cache.blob_path('md5', name), (time.time() - age, time.time() - age))
+
+    assert cache.get('md5', 'a') is not None
+    tmpdir.join('c').write('c' * 100)
+    assert cache.put(str(tmpdir.join('c')), 'md5', 'c') is True
+    assert cache.get('md5', 'b') is None
+    assert cache.get('md5', 'a') is not None
+    assert cache.get('md5', 'c') is not None
+
+    tmpdir.join('d').write('d' * 300)
+    assert cache.put(str(tmpdir.join('d')), 'md5', 'd') is False
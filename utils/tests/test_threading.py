@@ -1,11 +1,19 @@
 # coding=utf-8
 
+import asyncio
+import itertools
+import os
+import threading
 import time
+from concurrent.futures import TimeoutError
 
 import pytest
 from hypothesis import strategies as st, given, example
 
-from utils.threadpool import ThreadPool
+from utils.threadpool import AsyncThreadPool, CancelToken, Histogram, MetricsExporter, PoolRegistry, RateLimiter, \
+    RetryPolicy, TaskCancelledError, TaskGraph, TaskQueue, TaskTimeoutError, ThreadPool, current_cancel_token, \
+    get_shared_pool, get_timer, register_metrics_exporter, start_metrics_export, stop_metrics_export, \
+    unregister_metrics_exporter, worker_resource
 
 
 def sleep(t=0.1):
@@ -51,3 +59,896 @@ def test_queue_task():
     p.join_all()
     time.sleep(0.1)
     assert p.all_done()
+
+
+def test_idle_pool_picks_up_task_immediately():
+    p = ThreadPool(1, 'test', True)
+    done = threading.Event()
+    time.sleep(0.05)
+    start = time.time()
+    p.queue_task(done.set)
+    assert done.wait(1)
+    assert time.time() - start < 0.05
+    p.join_all(False, False)
+
+
+def test_killed_idle_thread_exits():
+    p = ThreadPool(2, 'test', True)
+    threads = list(p.threads)
+    p.set_thread_count(0)
+    for t in threads:
+        t.join(1)
+        assert not t.is_alive()
+
+
+def test_submit():
+    p = ThreadPool(2, 'test', True)
+    callback = []
+    future = p.submit(pow, 2, 8)
+    future.add_done_callback(callback.append)
+    assert future.result(1) == 256
+    assert future.exception() is None
+    assert callback == [future]
+
+    future = p.submit(int, 'not an int')
+    with pytest.raises(ValueError):
+        future.result(1)
+    assert isinstance(future.exception(), ValueError)
+    p.join_all(False, False)
+
+
+def test_submit_cancel():
+    p = ThreadPool(0, 'test', True)
+    ran = []
+    future = p.submit(ran.append, 1)
+    assert future.cancel()
+    p.set_thread_count(1)
+    p.join_all()
+    assert future.cancelled()
+    assert not ran
+
+
+@pytest.mark.parametrize('chunksize', [1, 3, 50])
+def test_map(chunksize):
+    p = ThreadPool(4, 'test', True)
+    assert list(p.map(pow, range(20), [2] * 20, chunksize=chunksize)) == [x ** 2 for x in range(20)]
+    assert sorted(p.imap_unordered(abs, range(-10, 10), chunksize=chunksize)) == sorted(abs(x) for x in range(-10, 10))
+    with pytest.raises(ValueError):
+        p.map(abs, range(10), chunksize=0)
+    p.join_all(False, False)
+
+
+def test_map_timeout():
+    p = ThreadPool(1, 'test', True)
+    results = p.map(sleep, [0.5, 0.5], timeout=0.1)
+    with pytest.raises(TimeoutError):
+        list(results)
+    p.join_all(False, False)
+
+
+def test_priority():
+    p = ThreadPool(0, 'test', True)
+    order = []
+    for priority in [0, 2, 1, 2, 0]:
+        p.queue_task(order.append, [priority], _priority=priority)
+    p.submit(order.append, 3, _priority=3)
+    p.set_thread_count(1)
+    p.join_all()
+    assert order == [3, 2, 2, 1, 0, 0]
+
+
+def test_lanes():
+    queue = TaskQueue()
+    queue.set_lane_weight('bulk', 1)
+    queue.set_lane_weight('interactive', 3)
+    for i in range(8):
+        queue.append(('bulk', i), lane='bulk')
+        queue.append(('interactive', i), lane='interactive')
+    first = [queue.popleft()[0] for _ in range(8)]
+    assert first.count('interactive') == 6
+    assert first.count('bulk') == 2
+    queue.append(('urgent', 0), priority=1, lane='bulk')
+    assert queue.popleft() == ('urgent', 0)
+    assert len(queue) == 8
+    with pytest.raises(ValueError):
+        queue.set_lane_weight('bulk', 0)
+
+
+def test_idle_lane_does_not_bank_share():
+    queue = TaskQueue()
+    for i in range(10):
+        queue.append(('bulk', i), lane='bulk')
+    for _ in range(10):
+        queue.popleft()
+    for i in range(4):
+        queue.append(('bulk', i), lane='bulk')
+        queue.append(('other', i), lane='other')
+    first = [queue.popleft()[0] for _ in range(3)]
+    assert first.count('other') == 2
+
+
+@pytest.mark.parametrize('size', [0, -1, 1.5, True, 'text'])
+def test_wrong_max_queue_size(size):
+    with pytest.raises(ValueError):
+        ThreadPool(1, 'test', True, _max_queue_size=size)
+
+
+def test_bounded_queue():
+    p = ThreadPool(0, 'test', True, _max_queue_size=2)
+    assert p.queue_task(sleep, [0])
+    assert p.try_queue_task(sleep, [0])
+    assert not p.try_queue_task(sleep, [0])
+    start = time.time()
+    assert not p.queue_task(sleep, [0], _timeout=0.1)
+    assert time.time() - start >= 0.1
+    p.set_thread_count(1)
+    assert p.queue_task(sleep, [0], _timeout=1)
+    p.join_all()
+
+
+def test_bounded_queue_blocks_producer():
+    p = ThreadPool(1, 'test', True, _max_queue_size=1)
+    start = time.time()
+    for _ in range(4):
+        assert p.queue_task(sleep, [0.05])
+    assert time.time() - start >= 0.1
+    p.join_all()
+
+
+def test_wrong_max_threads():
+    with pytest.raises(ValueError):
+        ThreadPool(2, 'test', True, _max_threads=1)
+
+
+def test_autoscaling():
+    p = ThreadPool(1, 'test', True, _max_threads=4, _keep_alive=0.1)
+    for _ in range(8):
+        p.queue_task(sleep, [0.1])
+    assert p.get_thread_count() == 4
+    time.sleep(0.5)
+    assert p.get_thread_count() == 1
+    p.join_all()
+
+
+def test_autoscaling_on_wait_time():
+    p = ThreadPool(1, 'test', True, _max_threads=2, _scale_up_depth=100, _scale_up_wait=0.05)
+    for _ in range(3):
+        p.queue_task(sleep, [0.1])
+    assert p.get_thread_count() == 1
+    time.sleep(0.15)
+    assert p.get_thread_count() == 2
+    p.join_all()
+
+
+def test_shrink_kills_idle_threads_first():
+    p = ThreadPool(2, 'test', True)
+    p.queue_task(sleep, [0.2])
+    time.sleep(0.05)
+    busy = [t for t in p.threads if t.is_busy]
+    assert len(busy) == 1
+    p.set_thread_count(1)
+    assert p.threads == busy
+    p.join_all()
+
+
+def test_process_pool():
+    p = ThreadPool(2, 'test', True, _use_processes=True)
+    assert p.submit(os.getpid).result(10) != os.getpid()
+    assert list(p.map(pow, range(10), [2] * 10, chunksize=3)) == [x ** 2 for x in range(10)]
+
+    results, errors = [], []
+    p.queue_task(pow, [2, 8], _task_callback=results.append, _task_id='pow')
+    p.queue_task(int, ['not an int'], _err_callback=errors.append, _err_args=['int'])
+    p.queue_task(lambda: None, _err_callback=errors.append, _err_args=['lambda'])
+    with pytest.raises(ValueError, match='cannot be sent'):
+        p.submit(abs, threading.Lock()).result(10)
+    with pytest.raises(TypeError):
+        p.submit(abs, 'not a number').result(10)
+    p.join_all()
+    assert results == [('pow', 256)]
+    assert sorted(errors) == ['int', 'lambda']
+
+
+def test_asyncio_bridge():
+    p = ThreadPool(2, 'test', True)
+    executor = AsyncThreadPool(p)
+    loop = asyncio.new_event_loop()
+
+    async def main():
+        threads = {threading.current_thread()}
+
+        def task(x):
+            threads.add(threading.current_thread())
+            return x * 2
+
+        assert await p.submit_async(task, 2) == 4
+        assert await executor.run(task, 3) == 6
+        assert await loop.run_in_executor(executor, task, 4) == 8
+        with pytest.raises(ValueError):
+            await p.submit_async(int, 'not an int')
+        assert len(threads) > 1
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    executor.shutdown()
+
+
+def test_asyncio_cancel():
+    p = ThreadPool(0, 'test', True)
+    loop = asyncio.new_event_loop()
+    ran = []
+
+    async def main():
+        future = p.submit_async(ran.append, 1)
+        future.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await future
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    p.set_thread_count(1)
+    p.join_all()
+    assert not ran
+
+
+def test_task_graph():
+    p = ThreadPool(4, 'test', True)
+    graph = TaskGraph(p)
+    root = graph.add(sleep, 0.05)
+    left = graph.add(lambda _, x: x * 2, 2, _depends_on=[root])
+    right = graph.add(lambda _, x: x * 3, x=3, _depends_on=[root])
+    join = graph.add(lambda a, b: a + b, _depends_on=[left, right])
+    assert not join.done()
+    assert graph.wait(1)
+    assert join.result() == 13
+    p.join_all()
+
+
+def test_task_graph_failure_cancels_dependents():
+    p = ThreadPool(2, 'test', True)
+    graph = TaskGraph(p)
+    ran = []
+    fail = graph.add(int, 'not an int')
+    ok = graph.add(abs, -1)
+    child = graph.add(ran.append, _depends_on=[fail, ok])
+    grandchild = graph.add(ran.append, _depends_on=[child])
+    assert graph.wait(1)
+    assert isinstance(fail.exception(), ValueError)
+    assert ok.result() == 1
+    assert child.cancelled()
+    assert grandchild.cancelled()
+    assert not ran
+    p.join_all()
+
+
+def test_task_graph_cancel():
+    p = ThreadPool(1, 'test', True)
+    graph = TaskGraph(p)
+    ran = []
+    root = graph.add(sleep, 0.1)
+    first = graph.add(int, 'not an int')
+    second = graph.add(int, 'not an int either')
+    child = graph.add(ran.append, _depends_on=[first, second, root])
+    graph.cancel()
+    assert graph.wait(1)
+    assert child.cancelled()
+    assert not ran
+    p.join_all()
+
+
+def test_cancel_queued_task():
+    p = ThreadPool(0, 'test', True, _max_queue_size=3)
+    ran = []
+    p.queue_task(ran.append, ['a'], _task_id='a')
+    p.queue_task(ran.append, ['b'], _task_id='b')
+    future = p.submit(ran.append, 'a', _task_id='a')
+    assert p.cancel_task('a') == 2
+    assert future.cancelled()
+    assert p.try_queue_task(ran.append, ['c'])
+    assert p.cancel_task('nope') == 0
+    p.set_thread_count(1)
+    p.join_all()
+    assert ran == ['b', 'c']
+    assert p.all_done()
+
+
+def test_cancel_running_task():
+    p = ThreadPool(1, 'test', True)
+
+    def cooperative():
+        token = current_cancel_token()
+        token.wait(5)
+        token.raise_if_cancelled()
+
+    future = p.submit(cooperative, _task_id='task')
+    time.sleep(0.05)
+    assert p.cancel_task('task') == 1
+    with pytest.raises(TaskCancelledError):
+        future.result(1)
+    p.join_all()
+
+
+def test_coalesce():
+    p = ThreadPool(0, 'test', True)
+    calls = []
+    results = []
+
+    def fetch(value):
+        calls.append(value)
+        return value * 2
+
+    assert p.queue_task(fetch, [1], _task_id='fetch', _coalesce=True, _task_callback=results.append)
+    assert p.queue_task(fetch, [1], _task_id='fetch', _coalesce=True, _task_callback=results.append)
+    future = p.submit(fetch, 1, _task_id='fetch', _coalesce=True)
+    p.queue_task(fetch, [1], _task_id='fetch', _task_callback=results.append)
+    assert p.metrics_snapshot()['tasks']['coalesced'] == 2
+    p.set_thread_count(1)
+    assert future.result(1) == 2
+    assert p.submit(fetch, 2, _task_id='fetch', _coalesce=True).result(1) == 4
+    assert p.submit(fetch, 2, _task_id='fetch', _coalesce=True).result(1) == 4
+    with pytest.raises(ValueError):
+        p.queue_task(fetch, [1], _coalesce=True)
+    p.join_all()
+    assert calls == [1, 1, 2, 2]
+    assert results == [('fetch', 2)] * 3
+    assert p.all_done()
+
+
+def test_coalesce_error_and_cancel():
+    p = ThreadPool(0, 'test', True)
+    errors = []
+    leader = p.submit(int, 'x', _task_id='int', _coalesce=True)
+    follower = p.submit(int, 'y', _task_id='int', _coalesce=True)
+    p.queue_task(int, ['z'], _task_id='int', _coalesce=True, _err_callback=errors.append, _err_args=['error'])
+    p.set_thread_count(1)
+    with pytest.raises(ValueError):
+        follower.result(1)
+    assert leader.exception(1) is not None
+    p.join_all()
+    assert errors == ['error']
+
+    p = ThreadPool(0, 'test', True)
+    leader = p.submit(abs, -1, _task_id='abs', _coalesce=True)
+    follower = p.submit(abs, -1, _task_id='abs', _coalesce=True)
+    assert p.cancel_task('abs') == 1
+    assert leader.cancelled()
+    assert follower.cancelled()
+    assert p.submit(abs, -1, _task_id='abs', _coalesce=True) is not follower
+
+
+def test_time_limit():
+    p = ThreadPool(1, 'test', True)
+    errors = []
+    tokens = []
+
+    def stuck():
+        tokens.append(current_cancel_token())
+        time.sleep(0.5)
+
+    stuck_thread = p.threads[0]
+    p.queue_task(stuck, _time_limit=0.05, _err_callback=errors.append, _err_args=['timeout'])
+    future = p.submit(sleep, 0.5, _time_limit=0.05)
+    with pytest.raises(TaskTimeoutError):
+        future.result(1)
+    assert errors == ['timeout']
+    assert tokens[0].is_cancelled
+    assert stuck_thread not in p.threads
+    assert p.get_thread_count() == 1
+    assert p.submit(abs, -1).result(1) == 1
+    p.join_all()
+
+
+def test_time_limit_slow_error_callback():
+    # The error callback of a timed out task must not hold up the timers of the process
+    p = ThreadPool(1, 'test', True)
+    errors = []
+    fired = threading.Event()
+
+    def slow_error_callback():
+        time.sleep(0.5)
+        errors.append('timeout')
+
+    p.queue_task(sleep, [0.5], _time_limit=0.01, _err_callback=slow_error_callback)
+    time.sleep(0.05)
+    get_timer().call_later(0.01, fired.set)
+    assert fired.wait(0.2)
+    assert errors == []
+    assert p.submit(abs, -1).result(0.2) == 1
+    p.join_all()
+    assert errors == ['timeout']
+
+
+def test_force_join_cancels_tasks():
+    p = ThreadPool(1, 'test', True)
+    cancelled = threading.Event()
+    p.queue_task(lambda: current_cancel_token().wait(5) and cancelled.set())
+    pending = p.submit(abs, -1)
+    time.sleep(0.05)
+    p.join_all(False, False)
+    assert cancelled.wait(1)
+    assert pending.cancelled()
+
+
+def test_cancel_token_outside_pool():
+    assert not current_cancel_token().is_cancelled
+    token = CancelToken()
+    assert not token.wait(0.01)
+    token.cancel()
+    assert token.wait()
+    with pytest.raises(TaskCancelledError):
+        token.raise_if_cancelled()
+
+
+def test_metrics():
+    p = ThreadPool(2, 'metrics', True)
+    p.queue_task(sleep, [0.05])
+    p.queue_task(int, ['not an int'])
+    p.submit(sleep, 0.5, _time_limit=0.01)
+    p.join_all()
+    snapshot = p.metrics_snapshot()
+    assert snapshot['pool'] == 'metrics'
+    assert snapshot['tasks'] == {
+        'queued': 3, 'started': 3, 'coalesced': 0, 'retried': 0,
+        'completed': 1, 'failed': 1, 'cancelled': 0, 'timed_out': 1,
+    }
+    assert snapshot['queue_wait']['count'] == 3
+    assert snapshot['run_time']['count'] == 3
+    assert snapshot['run_time']['max'] >= 0.05
+    assert snapshot['busy_seconds'] >= 0.05
+    assert snapshot['queue_depth'] == 0
+
+
+def test_metrics_busy_time_of_timed_out_task():
+    p = ThreadPool(1, 'metrics', True)
+    p.queue_task(sleep, [0.2], _time_limit=0.1)
+    time.sleep(0.3)
+    p.join_all()
+    snapshot = p.metrics_snapshot()
+    assert snapshot['tasks']['timed_out'] == 1
+    assert snapshot['run_time']['max'] >= 0.1
+    assert 0.2 <= snapshot['busy_seconds'] < 0.28
+
+
+def test_metrics_exporter():
+    class Exporter(MetricsExporter):
+        def __init__(self):
+            self.snapshots = []
+
+        def export(self, snapshots: list):
+            self.snapshots.extend(snapshots)
+
+    with pytest.raises(TypeError):
+        register_metrics_exporter(print)
+    with pytest.raises(TypeError):
+        type('Incomplete', (MetricsExporter,), {})()
+    exporter = Exporter()
+    p = ThreadPool(1, 'exported', True)
+    register_metrics_exporter(exporter)
+    try:
+        start_metrics_export(0.01)
+        time.sleep(0.1)
+        stop_metrics_export()
+    finally:
+        unregister_metrics_exporter(exporter)
+    assert 'exported' in [snapshot['pool'] for snapshot in exporter.snapshots]
+    count = len(exporter.snapshots)
+    time.sleep(0.05)
+    assert len(exporter.snapshots) == count
+    p.join_all()
+
+
+def test_slow_metrics_exporter():
+    # A slow exporter must not hold up the timers of the process
+    class Exporter(MetricsExporter):
+        def export(self, snapshots: list):
+            exporting.set()
+            time.sleep(0.3)
+
+    exporter = Exporter()
+    exporting = threading.Event()
+    fired = threading.Event()
+    register_metrics_exporter(exporter)
+    try:
+        start_metrics_export(0.01)
+        assert exporting.wait(1)
+        get_timer().call_later(0.01, fired.set)
+        assert fired.wait(0.2)
+    finally:
+        stop_metrics_export()
+        unregister_metrics_exporter(exporter)
+
+
+def test_histogram():
+    histogram = Histogram((1, 2, 3))
+    for value in [0.5, 1.5, 1.5, 2.5, 10]:
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == {'1': 1, '2': 2, '3': 1, '+Inf': 1}
+    assert snapshot['p50'] == 2
+    assert snapshot['p99'] == 10
+    assert snapshot['max'] == 10
+
+
+def test_rate_limiter():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+    with pytest.raises(ValueError):
+        RateLimiter(1, burst=0)
+    limiter = RateLimiter(10, 1, burst=2)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    assert 0 < limiter.try_acquire() <= 0.1
+    assert not limiter.acquire(0.01)
+    assert limiter.acquire(1)
+
+    limiter.update_quota(0, 0.2)
+    assert limiter.try_acquire() > 0.1
+    limiter.update_quota(5, 10)
+    assert limiter.fill_rate == 0.5
+    limiter.update_from_headers({'X-RateLimit-Remaining': '100', 'X-RateLimit-Reset': str(int(time.time()) + 1000)})
+    assert 0.09 < limiter.fill_rate < 0.11
+    limiter.update_from_headers({})
+    assert 0.09 < limiter.fill_rate < 0.11
+
+
+def test_rate_limited_pool():
+    p = ThreadPool(4, 'test', True, _rate_limit=RateLimiter(20, 1, burst=2))
+    start_times = []
+    start = time.time()
+    for _ in range(6):
+        p.queue_task(lambda: start_times.append(time.time()))
+    p.join_all()
+    assert len(start_times) == 6
+    assert max(start_times) - start >= 0.18
+
+
+def test_retry_policy():
+    with pytest.raises(ValueError):
+        RetryPolicy(0)
+    with pytest.raises(ValueError):
+        RetryPolicy(base_delay=2, max_delay=1)
+    with pytest.raises(ValueError):
+        RetryPolicy(jitter=2)
+    policy = RetryPolicy(3, (OSError,), base_delay=1, max_delay=3, jitter=0)
+    assert [policy.delay(attempts) for attempts in (1, 2, 3)] == [1, 2, 3]
+    assert policy.should_retry(OSError(), 2)
+    assert not policy.should_retry(OSError(), 3)
+    assert not policy.should_retry(ValueError(), 1)
+    assert 0 < RetryPolicy(base_delay=1).delay(1) <= 1
+
+
+def test_retry():
+    p = ThreadPool(1, 'test', True)
+    attempts = []
+    errors = []
+    results = []
+
+    def flaky(succeed_at):
+        attempts.append(threading.current_thread())
+        if len(attempts) < succeed_at:
+            raise OSError('flaky')
+        return len(attempts)
+
+    policy = RetryPolicy(3, (OSError,), base_delay=0.01, max_delay=0.01)
+    future = p.submit(flaky, 3, _retry=policy)
+    assert future.result(1) == 3
+
+    del attempts[:]
+    p.queue_task(flaky, [5], _retry=policy, _task_callback=results.append, _err_callback=errors.append,
+                 _err_args=['failed'])
+    p.join_all()
+    assert len(attempts) == 3
+    assert errors == ['failed']
+    assert not results
+    assert p.metrics_snapshot()['tasks']['retried'] == 4
+    assert p.all_done()
+
+
+def test_retry_does_not_block_worker():
+    p = ThreadPool(1, 'test', True)
+    calls = []
+
+    def failing():
+        calls.append('failing')
+        raise OSError()
+
+    failed = p.submit(failing, _task_id='failing', _retry=RetryPolicy(2, base_delay=5, max_delay=5, jitter=0))
+    time.sleep(0.05)
+    assert p.submit(calls.append, 'other').result(1) is None
+    assert calls == ['failing', 'other']
+    assert p.cancel_task('failing') == 1
+    with pytest.raises(TaskCancelledError):
+        failed.result(1)
+    p.join_all()
+    assert p.all_done()
+
+
+def test_schedule():
+    p = ThreadPool(1, 'test', True)
+    ran = []
+    start = time.time()
+    p.schedule_after(0.1, lambda: ran.append(('after', time.time())))
+    p.schedule_at(start + 0.05, lambda: ran.append(('at', time.time())))
+    cancelled = p.schedule_after(0.05, ran.append, 'cancelled')
+    cancelled.cancel()
+    time.sleep(0.3)
+    assert [name for name, _ in ran] == ['at', 'after']
+    assert ran[0][1] - start >= 0.05
+    assert ran[1][1] - start >= 0.1
+    assert not p.schedules
+    p.join_all()
+
+
+def test_schedule_every():
+    p = ThreadPool(2, 'test', True)
+    with pytest.raises(ValueError):
+        p.schedule_every(0, abs, -1)
+    with pytest.raises(ValueError):
+        p.schedule_every(1, abs, -1, _jitter=1)
+    times = []
+
+    def tick():
+        times.append(time.time())
+        if len(times) == 2:
+            raise RuntimeError('does not stop the schedule')
+
+    scheduled = p.schedule_every(0.05, tick, _jitter=0.2, _start_after=0)
+    time.sleep(0.32)
+    scheduled.cancel()
+    runs = scheduled.runs
+    assert 4 <= runs <= 9
+    assert all(0.04 <= later - earlier for earlier, later in zip(times, times[1:]))
+    time.sleep(0.1)
+    assert scheduled.runs == runs
+    assert scheduled.next_run is None
+
+    scheduled = p.schedule_every(10, tick)
+    assert scheduled.next_run > time.time() + 7
+    p.join_all()
+    assert scheduled.cancelled
+    assert not p.schedules
+
+
+def test_pool_registry():
+    with pytest.raises(ValueError):
+        PoolRegistry(0)
+    registry = PoolRegistry(4)
+    download = registry.get_pool('download', 2)
+    assert registry.get_pool('download') is download
+    assert download.get_thread_count() == 2
+    assert download.threads[0].name == 'download_1'
+    assert download.threads[0].daemon
+
+    updater = registry.get_pool('updater', 3)
+    assert updater.get_thread_count() == 2
+    assert registry.total_threads() == 4
+    assert registry.get_pool('download', 3).get_thread_count() == 2
+    assert registry.get_pool('other', 2).get_thread_count() == 1
+
+    registry.set_max_total_threads(None)
+    assert registry.get_pool('download', 3).get_thread_count() == 3
+    assert download.submit(abs, -1).result(1) == 1
+    registry.shutdown()
+    assert registry.total_threads() == 0
+    assert download.get_thread_count() == 0
+    assert registry.get_pool('download') is not download
+
+
+def test_shared_pool():
+    assert get_shared_pool('test_shared') is get_shared_pool('test_shared', 2)
+    assert get_shared_pool('test_shared').get_thread_count() == 2
+
+
+def test_work_stealing():
+    p = ThreadPool(4, 'test', True, _work_stealing=True)
+    threads = set()
+    done = threading.Event()
+    count = [0]
+    lock = threading.Lock()
+
+    def leaf():
+        threads.add(threading.current_thread().name)
+        time.sleep(0.001)
+        with lock:
+            count[0] += 1
+            if count[0] == 200:
+                done.set()
+
+    def spawn():
+        for _ in range(200):
+            p.queue_task(leaf)
+        assert not p.tasks
+
+    p.queue_task(spawn)
+    assert done.wait(5)
+    assert len(threads) > 1
+    p.join_all()
+    assert p.all_done()
+    assert p.metrics_snapshot()['tasks']['queued'] == 201
+    assert p.metrics_snapshot()['tasks']['completed'] == 201
+
+
+def test_work_stealing_cancel():
+    p = ThreadPool(1, 'test', True, _work_stealing=True)
+    ran = []
+    blocker = threading.Event()
+
+    def spawn():
+        p.queue_task(ran.append, ['cancelled'], _task_id='cancelled')
+        p.queue_task(ran.append, ['kept'])
+        blocker.wait(1)
+
+    p.queue_task(spawn)
+    time.sleep(0.05)
+    assert p.pending_jobs() == 3
+    assert p.cancel_task('cancelled') == 1
+    blocker.set()
+    p.join_all()
+    assert ran == ['kept']
+    assert p.all_done()
+
+
+def test_worker_resource():
+    class Session:
+        def __init__(self):
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    sessions = []
+    inits = []
+    exits = []
+
+    def get_session(_):
+        session = worker_resource('session', Session)
+        sessions.append((threading.current_thread().name, session))
+        return session
+
+    p = ThreadPool(2, 'test', True, _worker_init=lambda: inits.append(threading.current_thread().name),
+                   _worker_exit=lambda: exits.append(worker_resource('session', Session).closed))
+    results = list(p.map(get_session, range(20)))
+    p.join_all()
+    by_thread = {}
+    for name, session in sessions:
+        assert by_thread.setdefault(name, session) is session
+    assert len(set(map(id, results))) == len(by_thread)
+    assert all(session.closed for session in results)
+    assert sorted(inits) == ['test_1', 'test_2']
+    assert len(exits) == 2 and not any(exits)
+    assert worker_resource('session', Session) is not worker_resource('session', Session)
+
+
+def test_worker_hook_errors():
+    def fail():
+        raise RuntimeError()
+
+    p = ThreadPool(1, 'test', True, _worker_init=fail, _worker_exit=fail)
+    assert p.submit(abs, -1).result(1) == 1
+    p.join_all()
+
+
+def test_wait():
+    p = ThreadPool(2, 'test', True)
+    assert p.wait(0)
+    release = threading.Event()
+    p.queue_task(release.wait, [5])
+    for _ in range(5):
+        p.queue_task(time.sleep, [0.01])
+    assert not p.wait(0.05)
+    release.set()
+    start = time.monotonic()
+    assert p.wait(1)
+    assert time.monotonic() - start < 0.09
+    assert p.all_done()
+    assert p.submit(lambda: p.wait(1)).result(2)
+    p.join_all()
+
+
+def test_join_all_does_not_poll():
+    p = ThreadPool(1, 'test', True)
+    p.queue_task(time.sleep, [0.02])
+    start = time.monotonic()
+    p.join_all()
+    assert time.monotonic() - start < 0.09
+    assert p.all_done()
+
+
+def test_join_all_releases_resize_lock():
+    p = ThreadPool(1, 'test', True)
+    started = threading.Event()
+    counts = []
+
+    def count_threads():
+        started.set()
+        time.sleep(0.05)
+        counts.append(p.get_thread_count())
+
+    p.queue_task(count_threads)
+    assert started.wait(1)
+    joiner = threading.Thread(target=p.join_all, args=(False, True), daemon=True)
+    joiner.start()
+    joiner.join(2)
+    assert not joiner.is_alive()
+    assert counts == [0]
+
+
+def test_work_stealing_wait_does_not_poll():
+    p = ThreadPool(2, 'test', True, _work_stealing=True)
+    finished = []
+
+    def leaf():
+        time.sleep(0.002)
+        finished.append(time.monotonic())
+
+    def spawn():
+        for _ in range(10):
+            p.queue_task(leaf)
+
+    for _ in range(10):
+        p.queue_task(spawn)
+        assert p.wait(1)
+        assert time.monotonic() - finished[-1] < 0.03
+    assert len(finished) == 100
+
+    # Joining without waiting for running tasks: returns once the local tasks have all been taken
+    def spawn_and_block():
+        for _ in range(5):
+            p.queue_task(time.sleep, [0.01])
+        current_cancel_token().wait(5)
+
+    p.queue_task(spawn_and_block)
+    time.sleep(0.01)
+    start = time.monotonic()
+    p.join_all(True, False)
+    assert time.monotonic() - start < 0.09
+
+
+def test_drain():
+    p = ThreadPool(1, 'test', True)
+    ran = []
+    p.queue_task(time.sleep, [0.02])
+    p.queue_task(ran.append, [1])
+    assert p.drain(1)
+    assert ran == [1]
+    assert p.get_thread_count() == 0
+
+    p.set_thread_count(1)
+    p.queue_task(lambda: current_cancel_token().wait(5))
+    p.queue_task(ran.append, [2])
+    start = time.monotonic()
+    assert not p.drain(0.05)
+    assert time.monotonic() - start < 1
+    assert ran == [1]
+
+
+def test_context_manager():
+    ran = []
+    with ThreadPool(2, 'test', True) as p:
+        for i in range(10):
+            p.queue_task(ran.append, [i])
+    assert sorted(ran) == list(range(10))
+    assert p.get_thread_count() == 0
+    assert p.all_done()
+
+
+def test_work_stealing_stress():
+    # Thieves race with the owner and with each other over the same deques: no task may get lost
+    p = ThreadPool(16, 'test', True, _work_stealing=True)
+    counter = itertools.count()
+
+    def spawn():
+        for _ in range(500):
+            p.queue_task(next, [counter])
+
+    for round_ in range(1, 21):
+        for _ in range(32):
+            p.queue_task(spawn)
+        assert p.wait(10)
+        assert next(counter) == round_ * (32 * 500 + 1) - 1
+        assert p.pending_jobs() == 0
+    p.join_all()
@@ -1,5 +1,8 @@
 # coding=utf-8
 
+import threading
+import time
+
 import pytest
 from httmock import HTTMock
 
@@ -791,6 +794,94 @@ class TestUpdater:
         assert not Path('./update.vbs').exists()
         assert not Path('./update').exists()
 
+    def test_get_latest_release_shared_pool(self):
+        results = {}
+        done = threading.Event()
+
+        def make_updater(repo):
+            upd = GHUpdater(gh_user='132nd-etcher', gh_repo=repo)
+
+            def _get_latest_release(channel, branch):
+                time.sleep(0.1)
+                return repo
+
+            upd._get_latest_release = _get_latest_release
+            return upd
+
+        def callback(upd):
+            def _callback(result):
+                results[upd._gh_repo] = result
+                if len(results) == 2:
+                    done.set()
+            return _callback
+
+        # Both updaters run on the same shared pool, with the same channel and branch
+        for upd in (make_updater('repo-A'), make_updater('repo-B')):
+            upd.get_latest_release('stable', success_callback=callback(upd))
+        assert done.wait(5)
+        assert results == {'repo-A': 'repo-A', 'repo-B': 'repo-B'}
+
+    def test_shared_pool_blocked_hook(self):
+        release_hook = threading.Event()
+        hook_running = threading.Event()
+        done = threading.Event()
+
+        def _find_and_install_latest_release(**_):
+            hook_running.set()
+            # stands for an update hook waiting on the user
+            release_hook.wait(5)
+
+        blocked = GHUpdater(gh_user='132nd-etcher', gh_repo='repo-A')
+        blocked._find_and_install_latest_release = _find_and_install_latest_release
+        other = GHUpdater(gh_user='132nd-etcher', gh_repo='repo-B')
+        other._get_latest_release = lambda channel, branch: 'repo-B'
+        try:
+            blocked.find_and_install_latest_release('0.0.1', 'example.exe')
+            assert hook_running.wait(1)
+            other.get_latest_release('stable', success_callback=lambda _: done.set())
+            assert done.wait(1)
+        finally:
+            release_hook.set()
+
+    def test_overlapping_latest_release(self):
+        contacted = []
+        second_gathering = threading.Event()
+
+        class SlowGHUpdater(GHUpdater):
+            @property
+            def _release_caster(self):
+                def cast(version_str):
+                    if version_str == '0.0.1' and len(contacted) == 1:
+                        # the first call is about to add its last release: let the second one start gathering
+                        # (it cannot while the first one holds the updater's lock)
+                        second_gathering.wait(0.5)
+                    return DummyGHRel(version_str)
+                return cast
+
+            def _contact_remote_host_for_available_releases(self):
+                contacted.append(None)
+                if len(contacted) == 2:
+                    second_gathering.set()
+                    time.sleep(0.05)
+                return ['0.0.{}'.format(i) for i in range(10, 0, -1)]
+
+        upd = SlowGHUpdater(gh_user='132nd-etcher', gh_repo='EASI')
+        results = {}
+        done = threading.Semaphore(0)
+
+        def callback(branch):
+            def _callback(result):
+                results[branch] = result
+                done.release()
+            return _callback
+
+        # Two tasks of the same updater run at once on the shared pool
+        upd.get_latest_release('stable', success_callback=callback(None))
+        upd.get_latest_release('stable', 'other', success_callback=callback('other'))
+        assert done.acquire(timeout=5) and done.acquire(timeout=5)
+        assert results[None].version.version_str == '0.0.10'
+        assert results['other'].version.version_str == '0.0.10'
+
 
 class TestGHRelease:
     @pytest.mark.parametrize(
@@ -2,11 +2,21 @@
 """
 Creates a pool of threads that accepts any function, with or without arguments.
 
-Workers can be linked together
+Workers can be linked together with a TaskGraph
 """
+import asyncio
+import bisect
+import collections
+import heapq
+import itertools
+import pickle
+import random
 import threading
 import time
 import traceback
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import CancelledError, Executor, Future, ProcessPoolExecutor, as_completed, wait
 
 from utils.custom_logging import make_logger
 
@@ -26,24 +36,845 @@ def register_sentry(sentry_client_instance):
     SENTRY = sentry_client_instance
 
 
+class TaskCancelledError(Exception):
+    """Raised by CancelToken.raise_if_cancelled once the running task has been cancelled"""
+
+
+class TaskTimeoutError(Exception):
+    """Given to the Future of a task that exceeded its time limit"""
+
+
+class CancelToken:
+    """
+    Cooperative cancellation flag of a pooled task
+
+    Python threads cannot be interrupted: long-running tasks (downloads, paginated requests, ...) are expected to
+    check their token regularly, see current_cancel_token.
+    """
+
+    __slots__ = ('_cancelled', '_event')
+
+    _event_lock = threading.Lock()
+
+    def __init__(self):
+        self._cancelled = False
+        self._event = None
+
+    def cancel(self):
+        self._cancelled = True
+        event = self._event
+        if event is not None:
+            event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled
+
+    def raise_if_cancelled(self):
+        if self._cancelled:
+            raise TaskCancelledError('task has been cancelled')
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Sleeps until the token is cancelled or the timeout expires
+        :param timeout: maximum number of seconds to wait; None (default) to wait forever
+        :return: True if the token has been cancelled, False otherwise
+        """
+        with self._event_lock:
+            if self._event is None:
+                self._event = threading.Event()
+        if self._cancelled:
+            self._event.set()
+        return self._event.wait(timeout)
+
+
+def current_cancel_token() -> CancelToken:
+    """
+    Returns the CancelToken of the task running in the current pooled thread
+
+    Outside of a pooled thread (and in worker processes), returns a token that is never cancelled.
+    """
+    token = getattr(threading.current_thread(), 'cancel_token', None)
+    if token is None:
+        return CancelToken()
+    return token
+
+
+def worker_resource(name: str, factory: callable):
+    """
+    Returns the instance of a resource (typically an HTTP session) owned by the current pooled thread
+
+    The instance is created by calling "factory" the first time the thread asks for it, then reused by every task
+    running in that thread, so it is never shared between threads. It is closed (if it has a close method) when
+    the thread exits. Outside of a pooled thread, returns a new instance on every call.
+    :param name: name of the resource
+    :param factory: callable creating an instance of the resource
+    """
+    resources = getattr(threading.current_thread(), 'resources', None)
+    if resources is None:
+        return factory()
+    try:
+        return resources[name]
+    except KeyError:
+        resource = resources[name] = factory()
+        return resource
+
+
+class TimerHandle:
+    """A callback scheduled on the TimerThread"""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when: float, callback: callable, args: tuple):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerThread(threading.Thread):
+    """
+    Single daemon thread running callbacks at a given time (time.monotonic clock), shared by every pool
+
+    Callbacks run on the timer thread itself, and must return quickly (typically by queuing a task).
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='threadpool_timer', daemon=True)
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Condition(threading.Lock())
+
+    def call_at(self, when: float, callback: callable, *args) -> TimerHandle:
+        handle = TimerHandle(when, callback, args)
+        self._lock.acquire()
+        try:
+            heapq.heappush(self._heap, (when, next(self._counter), handle))
+            if self._heap[0][2] is handle:
+                self._lock.notify()
+        finally:
+            self._lock.release()
+        return handle
+
+    def call_later(self, delay: float, callback: callable, *args) -> TimerHandle:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                while True:
+                    if not self._heap:
+                        self._lock.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        handle = heapq.heappop(self._heap)[2]
+                        break
+                    self._lock.wait(delay)
+            finally:
+                self._lock.release()
+            if handle.cancelled:
+                continue
+            # noinspection PyBroadException
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception('caught error in timer callback: {}'.format(handle.callback))
+
+
+_TIMER = None
+_TIMER_LOCK = threading.Lock()
+
+
+def get_timer() -> TimerThread:
+    """
+    Returns the TimerThread shared by every pool, starting it if needed
+    """
+    global _TIMER
+    with _TIMER_LOCK:
+        if _TIMER is None:
+            _TIMER = TimerThread()
+            _TIMER.start()
+        return _TIMER
+
+
+class Histogram:
+    """
+    Distribution of durations, in seconds, counted in fixed buckets
+
+    Not thread-safe; the owning PoolMetrics guards it with its lock.
+    """
+
+    default_bounds = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 60)
+
+    def __init__(self, bounds: tuple = None):
+        self.bounds = tuple(bounds or self.default_bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile (the maximum for the last bucket)
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(.5),
+            'p99': self.quantile(.99),
+            'buckets': dict(zip([str(bound) for bound in self.bounds] + ['+Inf'], self.buckets)),
+        }
+
+
+class PoolMetrics:
+    """
+    Counters and histograms of a ThreadPool: how long tasks wait in the queue, how long they run, and how
+    they end
+
+    Only updated by the pool while it holds its task lock.
+    """
+
+    outcomes = ('completed', 'failed', 'cancelled', 'timed_out')
+
+    def __init__(self, task_lock):
+        self._task_lock = task_lock
+        self.counters = dict.fromkeys(('queued', 'started', 'coalesced', 'retried') + self.outcomes, 0)
+        self.queue_wait = Histogram()
+        self.run_time = Histogram()
+        self.busy_seconds = 0.0
+
+    def record_start(self, queue_wait: float):
+        self.counters['started'] += 1
+        self.queue_wait.observe(queue_wait)
+
+    def record_end(self, run_time: float, outcome: str = None, busy: bool = True):
+        if busy:
+            self.busy_seconds += run_time
+        if outcome is not None:
+            self.counters[outcome] += 1
+            self.run_time.observe(run_time)
+
+    def snapshot(self) -> dict:
+        self._task_lock.acquire()
+        try:
+            return {
+                'tasks': dict(self.counters),
+                'queue_wait': self.queue_wait.snapshot(),
+                'run_time': self.run_time.snapshot(),
+                'busy_seconds': self.busy_seconds,
+            }
+        finally:
+            self._task_lock.release()
+
+
+class MetricsExporter(ABC):
+    """
+    Receives the metrics snapshots of every ThreadPool, see register_metrics_exporter
+    """
+
+    @abstractmethod
+    def export(self, snapshots: list):
+        """"""
+
+
+class LoggingMetricsExporter(MetricsExporter):
+    """
+    Writes metrics snapshots to the module logger
+    """
+
+    def export(self, snapshots: list):
+        for snapshot in snapshots:
+            logger.debug('pool metrics: {}'.format(snapshot))
+
+
+_POOLS = weakref.WeakSet()
+_EXPORTERS = []
+# (thread, stop event) of the running export, if any
+_EXPORT = None
+_EXPORT_LOCK = threading.Lock()
+
+
+def register_metrics_exporter(exporter: MetricsExporter):
+    if not isinstance(exporter, MetricsExporter):
+        raise TypeError(type(exporter))
+    if exporter not in _EXPORTERS:
+        _EXPORTERS.append(exporter)
+
+
+def unregister_metrics_exporter(exporter: MetricsExporter):
+    if exporter in _EXPORTERS:
+        _EXPORTERS.remove(exporter)
+
+
+def export_metrics() -> list:
+    """
+    Sends the metrics snapshot of every live ThreadPool to the registered exporters
+    :return: the snapshots
+    """
+    snapshots = [pool.metrics_snapshot() for pool in list(_POOLS)]
+    for exporter in list(_EXPORTERS):
+        # noinspection PyBroadException
+        try:
+            exporter.export(snapshots)
+        except Exception:
+            logger.exception('caught error in metrics exporter: {}'.format(exporter))
+    return snapshots
+
+
+def start_metrics_export(interval: float):
+    """
+    Exports metrics every "interval" seconds, until stop_metrics_export is called
+
+    Exporters typically do I/O: they run on a thread of their own, not on the timer thread shared by every pool.
+    """
+    global _EXPORT
+
+    def export_loop():
+        while not stop.wait(interval):
+            export_metrics()
+
+    stop_metrics_export()
+    stop = threading.Event()
+    thread = threading.Thread(target=export_loop, name='threadpool_metrics', daemon=True)
+    with _EXPORT_LOCK:
+        _EXPORT = thread, stop
+    thread.start()
+
+
+def stop_metrics_export():
+    """
+    Stops the periodic export, waiting for an export in progress to complete
+    """
+    global _EXPORT
+    with _EXPORT_LOCK:
+        export, _EXPORT = _EXPORT, None
+    if export is not None:
+        thread, stop = export
+        stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+
+class RateLimiter:
+    """
+    Token bucket pacing the dispatch of tasks, typically to stay within the quota of a web API
+
+    Allows "rate" tasks every "per" seconds, with bursts of up to "burst" tasks. The same RateLimiter can be shared
+    by several pools drawing on the same quota. The actual rate can be lowered while running, from what the API
+    reports about the remaining quota, see RateLimiter.update_quota.
+    """
+
+    def __init__(self, rate: float, per: float = 1, burst: int = 1):
+        if rate <= 0 or per <= 0:
+            raise ValueError('rate and period must be > 0, got {} per {}s'.format(rate, per))
+        if burst < 1:
+            raise ValueError('burst must be >= 1, got {}'.format(burst))
+        self._lock = threading.Lock()
+        self.nominal_rate = rate / per
+        self.fill_rate = self.nominal_rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self._last_refill:
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.fill_rate)
+            self._last_refill = now
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token if one is available
+        :return: 0 if a token was taken, otherwise the number of seconds until the next one
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.fill_rate
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Waits for a token and takes it
+        :param timeout: maximum number of seconds to wait; None (default) to wait forever
+        :return: True if a token was taken, False if the timeout expired
+        """
+        if timeout is not None:
+            end_time = time.monotonic() + timeout
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return True
+            if timeout is not None:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+    def update_quota(self, remaining: int, reset_in: float):
+        """
+        Adapts the rate to the quota left, as reported by the remote API
+
+        The remaining calls are spread evenly until the quota resets (never faster than the nominal rate); once
+        the quota is exhausted, no token is handed out until it resets.
+        :param remaining: number of calls left in the current window
+        :param reset_in: number of seconds until the window resets
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining <= 0:
+                self._tokens = 0.0
+                self._blocked_until = now + max(reset_in, 0)
+                self.fill_rate = self.nominal_rate
+                return
+            self._blocked_until = 0.0
+            self._tokens = min(self._tokens, remaining)
+            if reset_in > 0:
+                self.fill_rate = min(self.nominal_rate, remaining / reset_in)
+            else:
+                self.fill_rate = self.nominal_rate
+
+    def update_from_headers(self, headers):
+        """
+        Calls RateLimiter.update_quota with the "X-RateLimit-Remaining" and "X-RateLimit-Reset" (epoch) headers
+        of a response, as sent by Github; does nothing if they are missing
+        """
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        self.update_quota(int(remaining), int(reset) - time.time())
+
+
+class RetryPolicy:
+    """
+    How a failing task is retried: how many times, on which exceptions, and how long to wait in between
+
+    The wait grows exponentially with each attempt, up to "max_delay"; "jitter" randomly shortens it (by up to
+    that fraction of the delay) so that tasks failing together do not all retry at the same time. Waits happen
+    on the shared TimerThread, without occupying a thread of the pool.
+    """
+
+    def __init__(self, max_attempts: int = 3, retry_on: tuple = (Exception,), base_delay: float = 1,
+                 max_delay: float = 60, multiplier: float = 2, jitter: float = 1):
+        if max_attempts < 1:
+            raise ValueError('max attempts must be >= 1, got {}'.format(max_attempts))
+        if base_delay < 0 or max_delay < base_delay:
+            raise ValueError('delays must satisfy 0 <= base delay <= max delay, got {} and {}'.format(
+                base_delay, max_delay))
+        if multiplier < 1:
+            raise ValueError('multiplier must be >= 1, got {}'.format(multiplier))
+        if not 0 <= jitter <= 1:
+            raise ValueError('jitter must be between 0 and 1, got {}'.format(jitter))
+        self.max_attempts = max_attempts
+        self.retry_on = retry_on
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def should_retry(self, error: BaseException, attempts: int) -> bool:
+        """
+        :param error: exception raised by the last attempt
+        :param attempts: number of attempts made so far
+        :return: True if the task should run again
+        """
+        return attempts < self.max_attempts and isinstance(error, self.retry_on)
+
+    def delay(self, attempts: int) -> float:
+        """
+        :param attempts: number of attempts made so far
+        :return: number of seconds to wait before the next attempt
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempts - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+def _run_with_optional_args(runnable: callable, args: list, kwargs: dict):
+    if args and kwargs:
+        return runnable(*args, **kwargs)
+    elif args:
+        return runnable(*args)
+    elif kwargs:
+        return runnable(**kwargs)
+    else:
+        return runnable()
+
+
+def _chunks(iterable, chunksize: int):
+    iterator = iter(iterable)
+    while True:
+        chunk = tuple(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _run_chunk(task: callable, chunk: tuple) -> list:
+    return [task(*args) for args in chunk]
+
+
+class PoolTask:
+    """A task waiting in, or taken from, a ThreadPool queue."""
+
+    __slots__ = ('task', 'args', 'kwargs', 'callback', 'err_callback', 'err_args', 'err_kwargs', 'task_id',
+                 'future', 'time_limit', 'cancel_token', 'completed', 'queued_at', 'followers', 'retry', 'attempts',
+                 'priority', 'lane', 'local')
+
+    def __init__(self, task, args, kwargs, callback, err_callback, err_args, err_kwargs, task_id,
+                 future: Future = None, time_limit: float = None, retry: RetryPolicy = None):
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.err_callback = err_callback
+        self.err_args = err_args
+        self.err_kwargs = err_kwargs
+        self.task_id = task_id
+        self.future = future
+        self.time_limit = time_limit
+        self.cancel_token = CancelToken()
+        self.completed = False
+        self.queued_at = time.monotonic()
+        self.followers = None
+        self.retry = retry
+        self.attempts = 1
+        self.priority = 0
+        self.lane = None
+        self.local = False
+
+
+class _Lane:
+    """Tasks of a TaskQueue lane, bucketed by priority."""
+
+    __slots__ = ('weight', 'pass_value', 'buckets', 'priorities', 'size')
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.pass_value = 0.0
+        self.buckets = {}
+        self.priorities = []
+        self.size = 0
+
+    @property
+    def head_priority(self) -> int:
+        return -self.priorities[0]
+
+
+class TaskQueue:
+    """
+    Task queue of a ThreadPool
+
+    Tasks with a higher priority are always dispatched first. Tasks of equal priority are dispatched in FIFO
+    order within a lane, and lanes share the pool according to their weight (stride scheduling): a lane with
+    a weight of 3 gets three times as many tasks dispatched as a lane with a weight of 1 while both are busy.
+
+    Not thread-safe; the owning ThreadPool guards it with its task lock.
+    """
+
+    def __init__(self):
+        self._lanes = {None: _Lane(1)}
+        self._active = set()
+        self._size = 0
+        self._virtual_time = 0.0
+
+    def set_lane_weight(self, lane: str, weight: float):
+        if weight <= 0:
+            raise ValueError('lane weight must be > 0, got {}'.format(weight))
+        try:
+            self._lanes[lane].weight = weight
+        except KeyError:
+            self._lanes[lane] = _Lane(weight)
+
+    def append(self, task: PoolTask, priority: int = 0, lane: str = None):
+        try:
+            lane_ = self._lanes[lane]
+        except KeyError:
+            lane_ = self._lanes[lane] = _Lane(1)
+        if not lane_.size:
+            # A lane that was idle does not get to bank its unused share
+            if lane_.pass_value < self._virtual_time:
+                lane_.pass_value = self._virtual_time
+            self._active.add(lane)
+        try:
+            lane_.buckets[priority].append(task)
+        except KeyError:
+            lane_.buckets[priority] = collections.deque((task,))
+            heapq.heappush(lane_.priorities, -priority)
+        lane_.size += 1
+        self._size += 1
+
+    def popleft(self) -> PoolTask:
+        if not self._size:
+            raise IndexError('pop from an empty TaskQueue')
+        if len(self._active) == 1:
+            for name in self._active:
+                best, best_name = self._lanes[name], name
+        else:
+            best = None
+            for name in self._active:
+                lane = self._lanes[name]
+                if best is None \
+                        or lane.head_priority > best.head_priority \
+                        or (lane.head_priority == best.head_priority and lane.pass_value < best.pass_value):
+                    best, best_name = lane, name
+
+        priority = -best.priorities[0]
+        bucket = best.buckets[priority]
+        task = bucket.popleft()
+        if not bucket:
+            del best.buckets[priority]
+            heapq.heappop(best.priorities)
+
+        self._virtual_time = best.pass_value
+        best.pass_value += 1 / best.weight
+        best.size -= 1
+        if not best.size:
+            self._active.discard(best_name)
+        self._size -= 1
+        return task
+
+    def remove_if(self, predicate: callable) -> list:
+        """
+        Removes, and returns, every queued task for which predicate(task) is true
+        """
+        removed = []
+        for name, lane in self._lanes.items():
+            for priority in list(lane.buckets):
+                bucket = lane.buckets[priority]
+                kept = collections.deque()
+                for task in bucket:
+                    if predicate(task):
+                        removed.append(task)
+                    else:
+                        kept.append(task)
+                if len(kept) == len(bucket):
+                    continue
+                lane.size -= len(bucket) - len(kept)
+                if kept:
+                    lane.buckets[priority] = kept
+                else:
+                    del lane.buckets[priority]
+                    lane.priorities.remove(-priority)
+                    heapq.heapify(lane.priorities)
+            if not lane.size:
+                self._active.discard(name)
+        self._size -= len(removed)
+        return removed
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+
+class ScheduledTask:
+    """
+    A task queued at a later time, or periodically, by ThreadPool.schedule_at, schedule_after or schedule_every
+
+    Waits happen on the shared TimerThread; the task only takes a thread of the pool while it runs. A periodic
+    task is scheduled again once a run is over, so that runs never overlap.
+    """
+
+    # seconds to wait before trying again to queue a one-off task when the queue of the pool is full
+    retry_delay = 1
+
+    def __init__(self, pool: 'ThreadPool', task: callable, args: tuple, kwargs: dict, interval: float = None,
+                 jitter: float = 0, options: dict = None):
+        self.pool = pool
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.options = options or {}
+        self.runs = 0
+        self.next_run = None
+        self.cancelled = False
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def schedule(self, delay: float):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.next_run = time.time() + delay
+            self._handle = get_timer().call_later(delay, self._queue)
+
+    def next_delay(self) -> float:
+        """
+        :return: number of seconds until the next run of a periodic task, jitter included
+        """
+        return self.interval * (1 + self.jitter * (2 * random.random() - 1))
+
+    def cancel(self):
+        """
+        Stops scheduling the task; a run that was already queued or started is not affected
+        """
+        with self._lock:
+            self.cancelled = True
+            self.next_run = None
+            if self._handle is not None:
+                self._handle.cancel()
+        self.pool.unschedule(self)
+
+    def _queue(self):
+        if self.cancelled:
+            return
+        if self.pool.queue_task(self._run, _block=False, **self.options):
+            return
+        if self.pool.is_joining:
+            return
+        logger.warning('queue full, could not start scheduled task: {}'.format(self.task))
+        if self.interval is None:
+            self.schedule(self.retry_delay)
+        else:
+            self.schedule(self.next_delay())
+
+    def _run(self):
+        self.runs += 1
+        try:
+            return _run_with_optional_args(self.task, self.args, self.kwargs)
+        finally:
+            if self.interval is None:
+                with self._lock:
+                    self.next_run = None
+                self.pool.unschedule(self)
+            else:
+                self.schedule(self.next_delay())
+
+
 class ThreadPool:
     """Flexible thread pool class.  Creates a pool of threads, then
     accepts tasks that will be dispatched to the next available
     thread."""
 
-    def __init__(self, _num_threads, _basename=None, _daemon=None):
+    def __init__(self,
+                 _num_threads,
+                 _basename=None,
+                 _daemon=None,
+                 _max_queue_size: int = None,
+                 _max_threads: int = None,
+                 _keep_alive: float = 60,
+                 _scale_up_depth: int = 1,
+                 _scale_up_wait: float = None,
+                 _use_processes: bool = False,
+                 _rate_limit: RateLimiter = None,
+                 _registry: 'PoolRegistry' = None,
+                 _work_stealing: bool = False,
+                 _worker_init: callable = None,
+                 _worker_exit: callable = None,
+                 ):
+
+        """Initialize the thread pool with numThreads workers.
 
-        """Initialize the thread pool with numThreads workers."""
+        Giving a maximum number of threads turns on autoscaling: the pool
+        then grows, one thread at a time, up to _max_threads when tasks
+        pile up, and threads above _num_threads exit after being idle for
+        _keep_alive seconds.
+
+        With _use_processes, tasks run in a pool of worker processes (one
+        per thread, up to _max_threads) so CPU-bound work is not serialized
+        by the GIL.  Threads still dispatch the tasks, and callbacks still
+        run in this process.  Tasks and their arguments must be picklable;
+        they fail with a ValueError otherwise (their error callback runs,
+        or their Future gets the error).
+
+        With _work_stealing, tasks queued by a task running in the pool go
+        to a deque owned by its thread, without taking the task lock: the
+        thread runs them next, most recent first, and idle threads steal
+        the oldest ones.  Such tasks ignore priorities, lanes and the
+        maximum queue size.
+        :param _max_queue_size: maximum number of pending tasks; None (default) for an unbounded queue
+        :param _max_threads: upper bound for autoscaling; None (default) for a fixed size pool
+        :param _keep_alive: seconds an extra thread may stay idle before exiting
+        :param _scale_up_depth: grow when that many queued tasks have no idle thread to run them
+        :param _scale_up_wait: grow when a task waited that many seconds in the queue; None to disable
+        :param _use_processes: run tasks in worker processes instead of the threads themselves
+        :param _rate_limit: RateLimiter pacing the dispatch of tasks; None (default) for no limit
+        :param _registry: PoolRegistry whose limit on the total number of threads applies to this pool
+        :param _work_stealing: give each thread its own deque for the tasks queued from within the pool
+        :param _worker_init: called without arguments in each new thread, before it runs any task (see also
+            worker_resource)
+        :param _worker_exit: called without arguments in each thread when it exits, before its resources are
+            closed"""
+        if _max_threads is not None and _max_threads < max(_num_threads, 1):
+            raise ValueError('max threads must be >= max(1, num threads), got {}'.format(_max_threads))
+        if _max_queue_size is not None and (isinstance(_max_queue_size, bool)
+                                            or not isinstance(_max_queue_size, int)
+                                            or _max_queue_size < 1):
+            raise ValueError('max queue size must be a positive int, got {}'.format(_max_queue_size))
         self.resize_lock = threading.Condition(threading.Lock())
-        self.tasks = []
+        self.tasks = TaskQueue()
         self.basename_suffix = 1
         self.is_daemon = _daemon
         self.threads = []
         self.ongoing_jobs = 0
         self.is_joining = False
         self.basename = _basename
-        self.task_lock = threading.Condition(threading.Lock())
+        self.max_queue_size = _max_queue_size
+        self.min_threads = _num_threads
+        self.max_threads = _max_threads
+        self.keep_alive = _keep_alive
+        self.scale_up_depth = _scale_up_depth
+        self.scale_up_wait = _scale_up_wait
+        self.idle_threads = 0
+        self.use_processes = _use_processes
+        self.process_executor = None
+        self.process_executor_lock = threading.Lock()
+        task_mutex = threading.Lock()
+        self.task_lock = threading.Condition(task_mutex)
+        self.queue_not_full = threading.Condition(task_mutex)
+        # Notified when the queue gets empty, or when no task is left, while someone waits for it
+        self.work_done = threading.Condition(task_mutex)
+        self.work_waiters = 0
+        self.metrics = PoolMetrics(self.task_lock)
+        self.coalescing = {}
+        self.retrying = set()
+        self.schedules = set()
+        self.rate_limiter = _rate_limit
+        self.registry = _registry
+        self.work_stealing = _work_stealing
+        self.worker_init = _worker_init
+        self.worker_exit = _worker_exit
+        # Threads owning a deque of local tasks; they stay here until they exit, even once removed from the pool
+        self.spawners = []
+        self.local_done = 0
+        self.retired_spawned = 0
         self.set_thread_count(_num_threads)
+        _POOLS.add(self)
 
     def set_thread_count(self, new_num_threads):
 
@@ -69,7 +900,21 @@ class ThreadPool:
         if necessary.  Internal use only; assumes the resizing lock is
         held."""
 
-        # If we need to grow the pool, do so
+        if self.registry is not None and new_num_threads > len(self.threads):
+            self.registry.thread_lock.acquire()
+            try:
+                self._add_threads(min(new_num_threads, max(len(self.threads) + self.registry.room(), 1)))
+            finally:
+                self.registry.thread_lock.release()
+        else:
+            self._add_threads(new_num_threads)
+        # If we need to shrink the pool, do so, retiring idle threads first
+        while new_num_threads < len(self.threads):
+            thread = next((t for t in self.threads if not t.is_busy), self.threads[0])
+            thread.kill()
+            self.threads.remove(thread)
+
+    def _add_threads(self, new_num_threads):
         while new_num_threads > len(self.threads):
             if self.basename:
                 thread_name = '{}_{}'.format(self.basename, self.basename_suffix)
@@ -78,11 +923,56 @@ class ThreadPool:
                 thread_name = None
             new_thread = ThreadPoolThread(self, _thread_name=thread_name, _daemon=self.is_daemon)
             self.threads.append(new_thread)
+            if self.work_stealing:
+                self.task_lock.acquire()
+                try:
+                    self.spawners.append(new_thread)
+                finally:
+                    self.task_lock.release()
             new_thread.start()
-        # If we need to shrink the pool, do so
-        while new_num_threads < len(self.threads):
-            self.threads[0].kill()
-            del self.threads[0]
+
+    @property
+    def is_autoscaling(self) -> bool:
+        return self.max_threads is not None
+
+    def grow(self):
+
+        """ Add one thread to an autoscaling pool, unless it already
+        reached its maximum size."""
+
+        self.resize_lock.acquire()
+        try:
+            if not self.is_joining and len(self.threads) < self.max_threads:
+                logger.debug('growing pool {} to {} threads'.format(self.basename, len(self.threads) + 1))
+                self.set_thread_count_no_lock(len(self.threads) + 1)
+        finally:
+            self.resize_lock.release()
+
+    def retire_idle_thread(self, thread: 'ThreadPoolThread'):
+
+        """ Called by a thread of an autoscaling pool that stayed idle
+        for longer than the keep alive delay.  The thread is killed
+        unless the pool is already at its minimum size."""
+
+        self.resize_lock.acquire()
+        try:
+            if thread in self.threads and len(self.threads) > self.min_threads:
+                logger.debug('shrinking pool {} to {} threads'.format(self.basename, len(self.threads) - 1))
+                thread.kill()
+                self.threads.remove(thread)
+        finally:
+            self.resize_lock.release()
+
+    def wake_all_threads(self):
+
+        """ Wake up every thread waiting for a task, so that dying
+        threads get a chance to exit their run loop."""
+
+        self.task_lock.acquire()
+        try:
+            self.task_lock.notify_all()
+        finally:
+            self.task_lock.release()
 
     def get_thread_count(self):
 
@@ -102,12 +992,24 @@ class ThreadPool:
                    _err_callback: callable = None,
                    _err_args: list = None,
                    _err_kwargs: dict = None,
-                   _task_id: str = None
+                   _task_id: str = None,
+                   _priority: int = 0,
+                   _lane: str = None,
+                   _block: bool = True,
+                   _timeout: float = None,
+                   _time_limit: float = None,
+                   _coalesce: bool = False,
+                   _retry: RetryPolicy = None,
                    ):
 
         """
         Inserts a task into the queue
+
+        If the pool has a maximum queue size and the queue is full, waits for a free slot (see _block and
+        _timeout).
         :param _task_id: gives an ID to the task in order to parse the result against something tangible
+        :param _priority: tasks with a higher priority are dispatched first
+        :param _lane: name of the lane to queue the task in (see ThreadPool.set_lane_weight)
         :param task: callable task
         :param args: args for the task as a list
         :param kwargs: kwargs for the task as a dict
@@ -115,90 +1017,1166 @@ class ThreadPool:
         :param _err_callback: callable to run in case of an error
         :param _err_args: args to _err_callback
         :param _err_kwargs: kwargs to _err_callback
+        :param _block: whether or not to wait for a free slot when the queue is full
+        :param _timeout: maximum number of seconds to wait for a free slot; None (default) to wait forever
+        :param _time_limit: maximum number of seconds the task may run (see ThreadPool.on_time_limit)
+        :param _coalesce: if a task with the same _task_id was queued with _coalesce and is still queued or running,
+            do not run this one: its callbacks get the outcome of the existing task instead
+        :param _retry: RetryPolicy of the task; _err_callback only runs once the last attempt failed
+        :return: True if the task was queued (or coalesced), False if the pool is joining or the queue stayed full
         """
         if self.is_joining:
             return False
+        self._check_task(task)
+        self._check_coalesce(_task_id, _coalesce)
+        pool_task = PoolTask(task, args, kwargs, _task_callback, _err_callback, _err_args, _err_kwargs, _task_id,
+                             time_limit=_time_limit, retry=_retry)
+        return self._put(pool_task, _priority, _lane, _block, _timeout, _coalesce)
+
+    @staticmethod
+    def _check_task(task: callable):
         if task is None or isinstance(task, bool) or not callable(task):
             raise ValueError('task must be a callable, got {}'.format(type(task)))
 
+    @staticmethod
+    def _check_coalesce(task_id, coalesce: bool):
+        if coalesce and task_id is None:
+            raise ValueError('only tasks with a _task_id can be coalesced')
+
+    def _put(self, pool_task: PoolTask, priority: int, lane: str, block: bool = True, timeout: float = None,
+             coalesce: bool = False):
+        if self.work_stealing and not coalesce and not priority and lane is None and self.rate_limiter is None:
+            thread = threading.current_thread()
+            if isinstance(thread, ThreadPoolThread) and thread.pool is self and not thread.is_dying:
+                self._push_local(thread, pool_task)
+                return True
+        must_grow = False
         self.task_lock.acquire()
         try:
-            self.tasks.append((task, args, kwargs, _task_callback, _err_callback, _err_args, _err_kwargs, _task_id))
+            if coalesce:
+                leader = self.coalescing.get(pool_task.task_id)
+                if leader is not None:
+                    if leader.followers is None:
+                        leader.followers = []
+                    leader.followers.append(pool_task)
+                    self.metrics.counters['coalesced'] += 1
+                    return True
+            if self.max_queue_size is not None and len(self.tasks) >= self.max_queue_size:
+                if not block:
+                    return False
+                if timeout is not None:
+                    end_time = time.monotonic() + timeout
+                while len(self.tasks) >= self.max_queue_size:
+                    if self.is_joining:
+                        return False
+                    if timeout is None:
+                        self.queue_not_full.wait()
+                    else:
+                        remaining = end_time - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        self.queue_not_full.wait(remaining)
+                if self.is_joining:
+                    return False
+            self.tasks.append(pool_task, priority, lane)
+            pool_task.priority, pool_task.lane = priority, lane
+            if coalesce:
+                self.coalescing[pool_task.task_id] = pool_task
             self.ongoing_jobs += 1
+            self.metrics.counters['queued'] += 1
+            if self.idle_threads:
+                self.task_lock.notify()
+            must_grow = self.is_autoscaling and len(self.tasks) - self.idle_threads >= self.scale_up_depth
+        finally:
+            self.task_lock.release()
+        if must_grow:
+            self.grow()
+        return True
+
+    def _push_local(self, thread: 'ThreadPoolThread', pool_task: PoolTask):
+        pool_task.local = True
+        thread.spawned += 1
+        thread.local_tasks.append(pool_task)
+        # Wake up a single thief; once it got a task, it wakes up the next one if there is more to steal (unlocked
+        # reads: at worst a thief misses this task, which its owner runs anyway)
+        if len(thread.local_tasks) == 1 and self.idle_threads:
+            self._wake_thief()
+
+    def _wake_thief(self):
+        self.task_lock.acquire()
+        try:
+            self.task_lock.notify()
+        finally:
+            self.task_lock.release()
+
+    def _pop_local(self, thread: 'ThreadPoolThread', locked: bool = False) -> PoolTask or None:
+        try:
+            pool_task = thread.local_tasks.pop()
+        except IndexError:
+            pass
+        else:
+            if not thread.local_tasks:
+                self._local_tasks_taken(locked)
+            return pool_task
+        victims = list(self.spawners)
+        offset = random.randrange(len(victims)) if victims else 0
+        for victim in itertools.chain(victims[offset:], victims[:offset]):
+            if victim is not thread:
+                try:
+                    pool_task = victim.local_tasks.popleft()
+                except IndexError:
+                    continue
+                # Steal half of the deque at once, so thieves come back less often; the owner and other thieves
+                # may empty it in the meantime
+                for _ in range(len(victim.local_tasks) // 2):
+                    try:
+                        thread.local_tasks.append(victim.local_tasks.popleft())
+                    except IndexError:
+                        break
+                if victim.local_tasks and self.idle_threads:
+                    if locked:
+                        self.task_lock.notify()
+                    else:
+                        self._wake_thief()
+                elif not victim.local_tasks:
+                    self._local_tasks_taken(locked)
+                return pool_task
+        return None
+
+    def _local_tasks_taken(self, locked: bool):
+        # A deque has been emptied without the task lock: wake up the threads waiting for queued tasks to be taken
+        # (see ThreadPool._wait_until). Unlocked read: a waiter registers before checking the deques.
+        if not self.work_waiters:
+            return
+        if locked:
+            self.work_done.notify_all()
+            return
+        self.task_lock.acquire()
+        try:
+            self.work_done.notify_all()
+        finally:
+            self.task_lock.release()
+
+    def _remove_local(self, predicate: callable) -> list:
+        removed = []
+        for thread in list(self.spawners):
+            for pool_task in [pool_task for pool_task in list(thread.local_tasks) if predicate(pool_task)]:
+                try:
+                    thread.local_tasks.remove(pool_task)
+                except ValueError:
+                    # started in the meantime
+                    continue
+                removed.append(pool_task)
+        return removed
+
+    def release_local_tasks(self, thread: 'ThreadPoolThread'):
+        """
+        Called by a worker thread of a work-stealing pool when it exits: its local tasks go to the shared queue
+        """
+        self.task_lock.acquire()
+        try:
+            if thread in self.spawners:
+                self.spawners.remove(thread)
+                self.retired_spawned += thread.spawned
+            while thread.local_tasks:
+                self.tasks.append(thread.local_tasks.popleft())
+            if self.tasks and self.idle_threads:
+                self.task_lock.notify_all()
+        finally:
+            self.task_lock.release()
+
+    def pending_jobs(self) -> int:
+        """
+        :return: number of tasks queued, running or waiting to be retried
+        """
+        self.task_lock.acquire()
+        try:
+            return self._pending_jobs_no_lock()
+        finally:
+            self.task_lock.release()
+
+    def _pending_jobs_no_lock(self) -> int:
+        if not self.work_stealing:
+            return self.ongoing_jobs
+        spawned = self.retired_spawned + sum(thread.spawned for thread in self.spawners)
+        return self.ongoing_jobs + spawned - self.local_done
+
+    def _has_pending_tasks_no_lock(self) -> bool:
+        return bool(self.tasks or self.retrying or any(thread.local_tasks for thread in self.spawners))
+
+    def _wait_until(self, predicate: callable, timeout: float = None) -> bool:
+        if timeout is not None:
+            end_time = time.monotonic() + timeout
+        self.task_lock.acquire()
+        self.work_waiters += 1
+        try:
+            while not predicate():
+                delay = None
+                if timeout is not None:
+                    delay = end_time - time.monotonic()
+                    if delay <= 0:
+                        return False
+                self.work_done.wait(delay)
+            return True
+        finally:
+            self.work_waiters -= 1
+            self.task_lock.release()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits until no task is queued, running or waiting to be retried (tasks scheduled for later do not count)
+
+        Tasks may still be queued in the meantime, including by the tasks themselves. When called from a task of
+        the pool, that task is not waited for.
+        :param timeout: maximum number of seconds to wait; None (default) to wait forever
+        :return: True if every task is done, False if the timeout expired
+        """
+        thread = threading.current_thread()
+        own_task = isinstance(thread, ThreadPoolThread) and thread.pool is self and thread.current_task is not None
+        return self._wait_until(lambda: self._pending_jobs_no_lock() <= own_task, timeout)
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Stops accepting tasks, waits for the queued and running ones, then stops the threads
+
+        Tasks left once the timeout expires are given up on, as with join_all(False, False): queued ones are
+        cancelled, running ones have their CancelToken cancelled. In both cases, the pool can be reused
+        afterwards (see ThreadPool.set_thread_count).
+        :param timeout: maximum number of seconds to wait; None (default) to wait forever
+        :return: True if every task was done in time, False otherwise
+        """
+        self.is_joining = True
+        done = self.wait(timeout)
+        self.join_all(done, done)
+        return done
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.join_all()
+        return False
+
+    def try_queue_task(self, task: callable, *args, **kwargs):
+        """
+        Inserts a task into the queue, unless the queue is full
+
+        Takes the same arguments as ThreadPool.queue_task.
+        :return: True if the task was queued, False otherwise
+        """
+        kwargs['_block'] = False
+        return self.queue_task(task, *args, **kwargs)
+
+    def set_lane_weight(self, lane: str, weight: float = 1):
+        """
+        Creates or re-weights a named lane
+
+        While several lanes have tasks of the same priority queued, each gets a share of the dispatched tasks
+        proportional to its weight.
+        :param lane: name of the lane
+        :param weight: relative share of the pool
+        """
+        self.task_lock.acquire()
+        try:
+            self.tasks.set_lane_weight(lane, weight)
+        finally:
+            self.task_lock.release()
+
+    def submit(self, task: callable, *args, _priority: int = 0, _lane: str = None, _task_id: str = None,
+               _time_limit: float = None, _coalesce: bool = False, _retry: RetryPolicy = None, **kwargs) -> Future:
+        """
+        Inserts a task into the queue and returns a Future tracking its execution
+
+        Exceptions raised by the task are stored in the Future instead of being logged. The Future can be
+        cancelled for as long as the task has not started.
+        :param task: callable task
+        :param args: args for the task
+        :param kwargs: kwargs for the task
+        :param _priority: tasks with a higher priority are dispatched first
+        :param _lane: name of the lane to queue the task in
+        :param _task_id: ID of the task, for ThreadPool.cancel_task
+        :param _time_limit: maximum number of seconds the task may run; the Future then gets a TaskTimeoutError
+        :param _coalesce: share the execution of a queued or running task with the same _task_id (see
+            ThreadPool.queue_task)
+        :param _retry: RetryPolicy of the task; the Future gets the exception of the last attempt
+        :return: concurrent.futures.Future
+        """
+        if self.is_joining:
+            raise RuntimeError('cannot submit a task while the pool is joining')
+        self._check_task(task)
+        self._check_coalesce(_task_id, _coalesce)
+        future = Future()
+        pool_task = PoolTask(task, args, kwargs, None, None, None, None, _task_id, future, _time_limit, _retry)
+        if not self._put(pool_task, _priority, _lane, coalesce=_coalesce):
+            raise RuntimeError('cannot submit a task while the pool is joining')
+        return future
+
+    def submit_async(self, task: callable, *args, _priority: int = 0, _lane: str = None,
+                     _loop: asyncio.AbstractEventLoop = None, **kwargs) -> asyncio.Future:
+        """
+        Same as ThreadPool.submit, but returns an asyncio Future that can be awaited
+
+        The asyncio Future is resolved on the event loop's thread once the task is done; cancelling it
+        cancels the task if it has not started yet.
+        :param _loop: event loop of the asyncio Future; defaults to the current event loop
+        :return: asyncio.Future
+        """
+        return asyncio.wrap_future(self.submit(task, *args, _priority=_priority, _lane=_lane, **kwargs), loop=_loop)
+
+    def map(self, task: callable, *iterables, timeout: float = None, chunksize: int = 1):
+        """
+        Equivalent to map(task, *iterables), but runs the calls in the pool
+
+        Results are yielded in order. Arguments are sent to the pool by chunks of "chunksize" calls, which
+        reduces overhead for large iterables of short tasks.
+        :param task: callable task
+        :param iterables: iterables of arguments for the task
+        :param timeout: maximum number of seconds to wait for the whole map
+        :param chunksize: number of calls per queued task
+        :return: iterator over the results
+        """
+        if chunksize < 1:
+            raise ValueError('chunksize must be >= 1, got {}'.format(chunksize))
+        if timeout is not None:
+            end_time = timeout + time.monotonic()
+        futures = [self.submit(_run_chunk, task, chunk) for chunk in _chunks(zip(*iterables), chunksize)]
+
+        def result_iterator():
+            try:
+                futures.reverse()
+                while futures:
+                    if timeout is None:
+                        results = futures.pop().result()
+                    else:
+                        results = futures.pop().result(end_time - time.monotonic())
+                    yield from results
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return result_iterator()
+
+    def imap_unordered(self, task: callable, iterable, timeout: float = None, chunksize: int = 1):
+        """
+        Like ThreadPool.map for a single iterable, but yields results as soon as they are available
+        :param task: callable task, called with one item of "iterable"
+        :param iterable: arguments for the task
+        :param timeout: maximum number of seconds to wait for the whole map
+        :param chunksize: number of calls per queued task
+        :return: iterator over the results
+        """
+        if chunksize < 1:
+            raise ValueError('chunksize must be >= 1, got {}'.format(chunksize))
+        futures = [self.submit(_run_chunk, task, chunk)
+                   for chunk in _chunks(((item,) for item in iterable), chunksize)]
+
+        def result_iterator():
+            try:
+                for future in as_completed(futures, timeout):
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return result_iterator()
+
+    def schedule_at(self, when: float, task: callable, *args, _priority: int = 0, _lane: str = None,
+                    _task_id: str = None, _time_limit: float = None, **kwargs) -> ScheduledTask:
+        """
+        Queues a task at a given time
+
+        If the queue is full at that time, the task is queued as soon as there is room for it.
+        :param when: time to queue the task at, in seconds since the epoch (see time.time)
+        :param task: callable task
+        :param args: args for the task
+        :param kwargs: kwargs for the task
+        :param _priority: tasks with a higher priority are dispatched first
+        :param _lane: name of the lane to queue the task in
+        :param _task_id: ID of the task, for ThreadPool.cancel_task
+        :param _time_limit: maximum number of seconds the task may run
+        :return: ScheduledTask, that can be cancelled
+        """
+        return self.schedule_after(when - time.time(), task, *args, _priority=_priority, _lane=_lane,
+                                   _task_id=_task_id, _time_limit=_time_limit, **kwargs)
+
+    def schedule_after(self, delay: float, task: callable, *args, _priority: int = 0, _lane: str = None,
+                       _task_id: str = None, _time_limit: float = None, **kwargs) -> ScheduledTask:
+        """
+        Queues a task after "delay" seconds
+
+        Takes the same arguments as ThreadPool.schedule_at.
+        :return: ScheduledTask, that can be cancelled
+        """
+        return self._schedule(max(delay, 0), None, 0, task, args, kwargs, _priority, _lane, _task_id, _time_limit)
+
+    def schedule_every(self, interval: float, task: callable, *args, _jitter: float = 0, _start_after: float = None,
+                       _priority: int = 0, _lane: str = None, _task_id: str = None, _time_limit: float = None,
+                       **kwargs) -> ScheduledTask:
+        """
+        Queues a task periodically, until the returned ScheduledTask is cancelled or the pool joins
+
+        The task is scheduled again "interval" seconds after each run ends, so runs never overlap; a run that
+        raises is logged like any other task, and does not stop the schedule. Takes the same arguments as
+        ThreadPool.schedule_at.
+        :param interval: seconds between two runs
+        :param _jitter: randomly lengthens or shortens each interval by up to that fraction of it, so that tasks
+            scheduled together spread out over time
+        :param _start_after: seconds until the first run; defaults to an interval (jitter included)
+        :return: ScheduledTask, that can be cancelled
+        """
+        if interval <= 0:
+            raise ValueError('interval must be > 0, got {}'.format(interval))
+        if not 0 <= _jitter < 1:
+            raise ValueError('jitter must be >= 0 and < 1, got {}'.format(_jitter))
+        return self._schedule(_start_after, interval, _jitter, task, args, kwargs, _priority, _lane, _task_id,
+                              _time_limit)
+
+    def _schedule(self, delay, interval, jitter, task, args, kwargs, priority, lane, task_id, time_limit):
+        if self.is_joining:
+            raise RuntimeError('cannot schedule a task while the pool is joining')
+        self._check_task(task)
+        options = dict(_priority=priority, _lane=lane, _task_id=task_id, _time_limit=time_limit)
+        scheduled = ScheduledTask(self, task, args, kwargs, interval, jitter, options)
+        self.task_lock.acquire()
+        try:
+            self.schedules.add(scheduled)
+        finally:
+            self.task_lock.release()
+        scheduled.schedule(scheduled.next_delay() if delay is None else delay)
+        return scheduled
+
+    def unschedule(self, scheduled: ScheduledTask):
+        """
+        Forgets about a ScheduledTask that was cancelled or is over
+        """
+        self.task_lock.acquire()
+        try:
+            self.schedules.discard(scheduled)
+        finally:
+            self.task_lock.release()
+
+    def cancel_schedules(self) -> int:
+        """
+        Cancels every task scheduled with ThreadPool.schedule_at, schedule_after or schedule_every
+        :return: number of ScheduledTask cancelled
+        """
+        self.task_lock.acquire()
+        try:
+            schedules = list(self.schedules)
+        finally:
+            self.task_lock.release()
+        for scheduled in schedules:
+            scheduled.cancel()
+        return len(schedules)
+
+    def _get_process_executor(self) -> ProcessPoolExecutor:
+        executor = self.process_executor
+        if executor is None:
+            self.process_executor_lock.acquire()
+            try:
+                if self.process_executor is None:
+                    self.process_executor = ProcessPoolExecutor(max(self.max_threads or self.min_threads, 1))
+                executor = self.process_executor
+            finally:
+                self.process_executor_lock.release()
+        return executor
+
+    def execute(self, task: callable, args: list, kwargs: dict):
+        """
+        Runs a task, either in the calling thread or in a worker process, and returns its result
+
+        For use only by ThreadPoolThread objects contained in the pool.
+        """
+        if not self.use_processes:
+            return _run_with_optional_args(task, args, kwargs)
+        try:
+            return self._get_process_executor().submit(_run_with_optional_args, task, args, kwargs).result()
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # Raised by the task itself, or by the executor when it cannot pickle the task (tasks are not pickled
+            # beforehand: they may carry large arguments); only tell them apart on failure
+            try:
+                pickle.dumps((task, args, kwargs))
+            except Exception:
+                raise ValueError('task cannot be sent to a worker process: {}: {}'.format(type(e).__name__, e)) from e
+            raise
+
+    def claim(self, pool_task: PoolTask, _thread: 'ThreadPoolThread' = None) -> bool:
+        """
+        Marks a task as completed; only the first caller gets True, and must then report the outcome of the task
+        and call ThreadPool.task_done
+
+        A task can be completed either by the thread running it, by its time limit, or by a cancellation. Once
+        claimed, a coalesced task stops accepting followers: identical tasks queued afterwards run on their own.
+        :param _thread: if given, only claim the task while that thread is running it
+        """
+        self.task_lock.acquire()
+        try:
+            if pool_task.completed or (_thread is not None and _thread.current_task is not pool_task):
+                return False
+            pool_task.completed = True
+            if self.coalescing and self.coalescing.get(pool_task.task_id) is pool_task:
+                del self.coalescing[pool_task.task_id]
             return True
         finally:
             self.task_lock.release()
 
-    def task_done(self):
+    @staticmethod
+    def settle_followers(pool_task: PoolTask, outcome: str, result=None, error: BaseException = None):
+        """
+        Hands the outcome of a claimed task over to the tasks that were coalesced with it
+
+        Followers get the same result or error as the task itself: their Future is resolved, or their callback
+        (or error callback) is called, in the calling thread.
+        :param pool_task: claimed task
+        :param outcome: how the task ended, see PoolMetrics.outcomes
+        :param result: return value of the task, if it completed
+        :param error: exception raised by the task, if it failed
+        """
+        followers, pool_task.followers = pool_task.followers, None
+        if not followers:
+            return
+        if outcome == 'timed_out':
+            error = TaskTimeoutError(pool_task.time_limit)
+        for follower in followers:
+            # noinspection PyBroadException
+            try:
+                if outcome == 'cancelled':
+                    follower.cancel_token.cancel()
+                    if follower.future is not None and follower.future.cancel():
+                        follower.future.set_running_or_notify_cancel()
+                elif follower.future is not None:
+                    if follower.future.set_running_or_notify_cancel():
+                        if outcome == 'completed':
+                            follower.future.set_result(result)
+                        else:
+                            follower.future.set_exception(error)
+                elif outcome == 'completed':
+                    if follower.callback is not None:
+                        follower.callback((follower.task_id, result))
+                elif follower.err_callback:
+                    _run_with_optional_args(follower.err_callback, follower.err_args, follower.err_kwargs)
+            except Exception:
+                logger.exception('caught error while settling coalesced task: {}'.format(follower.task_id))
+
+    def retry(self, thread: 'ThreadPoolThread', pool_task: PoolTask, error: BaseException) -> bool:
+        """
+        Called by worker thread when a task raised; schedules another attempt if its RetryPolicy allows it
+
+        The task goes back to the queue once its backoff delay has elapsed. Tasks are not retried once they were
+        completed by someone else, or when their thread is stopped by ThreadPool.join_all.
+        :return: True if the task will be retried, in which case the worker must not report its outcome
+        """
+        policy = pool_task.retry
+        if policy is None or not policy.should_retry(error, pool_task.attempts):
+            return False
+        self.task_lock.acquire()
+        try:
+            if pool_task.completed or pool_task.cancel_token.is_cancelled or (self.is_joining and thread.is_dying):
+                return False
+            thread.current_task = None
+            self.retrying.add(pool_task)
+            self.metrics.counters['retried'] += 1
+        finally:
+            self.task_lock.release()
+        delay = policy.delay(pool_task.attempts)
+        logger.warning('task failed ({}: {}), retrying in {:.2f}s (attempt {} of {}): {}'.format(
+            type(error).__name__, error, delay, pool_task.attempts + 1, policy.max_attempts, pool_task.task))
+        pool_task.attempts += 1
+        get_timer().call_later(delay, self._requeue, pool_task)
+        return True
+
+    def _requeue(self, pool_task: PoolTask):
+        self.task_lock.acquire()
+        try:
+            if pool_task not in self.retrying:
+                return
+            self.retrying.discard(pool_task)
+            pool_task.queued_at = time.monotonic()
+            self.tasks.append(pool_task, pool_task.priority, pool_task.lane)
+            if self.idle_threads:
+                self.task_lock.notify()
+        finally:
+            self.task_lock.release()
+
+    def cancel_task(self, task_id) -> int:
+        """
+        Cancels every task with the given ID
+
+        Queued tasks are removed from the queue (their Future, if any, is cancelled), and so are tasks waiting to be
+        retried (their Future gets a TaskCancelledError); running tasks have their CancelToken cancelled, and are
+        expected to stop by themselves.
+        :param task_id: _task_id given when queuing the task
+        :return: number of tasks cancelled
+        """
+        self.task_lock.acquire()
+        try:
+            removed = self.tasks.remove_if(lambda pool_task: pool_task.task_id == task_id)
+            removed.extend(self._remove_retrying(lambda pool_task: pool_task.task_id == task_id))
+            removed.extend(self._remove_local(lambda pool_task: pool_task.task_id == task_id))
+            running = [thread.current_task for thread in list(self.threads)
+                       if thread.current_task is not None and thread.current_task.task_id == task_id]
+        finally:
+            self.task_lock.release()
+        self._discard(removed)
+        for pool_task in running:
+            pool_task.cancel_token.cancel()
+        return len(removed) + len(running)
+
+    def _remove_retrying(self, predicate: callable) -> list:
+        removed = [pool_task for pool_task in self.retrying if predicate(pool_task)]
+        self.retrying.difference_update(removed)
+        return removed
+
+    def _discard(self, removed: list):
+        for pool_task in removed:
+            pool_task.cancel_token.cancel()
+            if self.claim(pool_task):
+                if pool_task.future is not None:
+                    if pool_task.future.cancel():
+                        pool_task.future.set_running_or_notify_cancel()
+                    else:
+                        # already running, between two attempts
+                        pool_task.future.set_exception(TaskCancelledError())
+                self.settle_followers(pool_task, 'cancelled')
+                self.task_done(0, 'cancelled', pool_task)
+        self.task_lock.acquire()
+        try:
+            self.queue_not_full.notify_all()
+        finally:
+            self.task_lock.release()
+
+    def cancel_pending_tasks(self) -> int:
+        """
+        Removes every task from the queue (and those waiting to be retried), cancelling their Future if any
+        :return: number of tasks removed
+        """
+        self.task_lock.acquire()
+        try:
+            removed = self.tasks.remove_if(lambda _: True)
+            removed.extend(self._remove_retrying(lambda _: True))
+            removed.extend(self._remove_local(lambda _: True))
+        finally:
+            self.task_lock.release()
+        self._discard(removed)
+        return len(removed)
+
+    def on_time_limit(self, thread: 'ThreadPoolThread', pool_task: PoolTask):
+        """
+        Called by the timer thread when a task exceeds its time limit
+
+        The task's CancelToken is cancelled and the task fails with a TaskTimeoutError (its error callback runs).
+        Since the thread cannot be interrupted, it is abandoned: it will exit once the task returns, and a fresh
+        thread takes its place in the pool. Replacing the thread and running the error callback may take a while,
+        so that happens on a short-lived thread of its own, leaving the timer thread free.
+        """
+        if not self.claim(pool_task, thread):
+            return
+        pool_task.cancel_token.cancel()
+        logger.error('task exceeded its time limit of {}s, abandoning thread {}:\ncmd: {} args: {} kwargs: {}'.format(
+            pool_task.time_limit, thread.name, pool_task.task, pool_task.args, pool_task.kwargs))
+        threading.Thread(target=self._abandon, args=(thread, pool_task), name='{}_timeout'.format(thread.name),
+                         daemon=True).start()
+
+    def _abandon(self, thread: 'ThreadPoolThread', pool_task: PoolTask):
+        # Replace the thread first: the pool may be saturated by stuck tasks, and the error callback may queue more
+        self.resize_lock.acquire()
+        try:
+            if thread in self.threads:
+                thread.kill()
+                self.threads.remove(thread)
+                if not self.is_joining:
+                    self.set_thread_count_no_lock(len(self.threads) + 1)
+        finally:
+            self.resize_lock.release()
+        try:
+            if pool_task.future is not None:
+                pool_task.future.set_exception(TaskTimeoutError(pool_task.time_limit))
+            elif pool_task.err_callback:
+                _run_with_optional_args(pool_task.err_callback, pool_task.err_args, pool_task.err_kwargs)
+        except Exception:
+            logger.exception('caught error in error callback of timed out task: {}'.format(pool_task.task))
+        finally:
+            self.settle_followers(pool_task, 'timed_out')
+            # The abandoned thread adds the time it actually ran for to the busy time once the task returns
+            self.task_done(pool_task.time_limit, 'timed_out', pool_task, busy=False)
+
+    def task_done(self, run_time: float = 0, outcome: str = None, pool_task: PoolTask = None,
+                  queue_wait: float = None, busy: bool = True):
         """
         Called by worker thread when a task is done (when the function called by the Worker returned)
+        :param run_time: seconds the task ran for
+        :param outcome: how the task ended, see PoolMetrics.outcomes; None if it was completed by someone else
+        :param pool_task: the task
+        :param queue_wait: seconds a local task (see _work_stealing) waited before starting, if it started
+        :param busy: whether or not run_time counts as busy time of the threads
         """
         self.task_lock.acquire()
         try:
-            if self.ongoing_jobs > 0:
+            if pool_task is not None and pool_task.local:
+                # Local tasks are counted here rather than when queued or started, to keep these lock-free
+                if queue_wait is not None:
+                    self.metrics.record_start(queue_wait)
+                if outcome is not None:
+                    self.local_done += 1
+                    self.metrics.counters['queued'] += 1
+            elif outcome is not None and self.ongoing_jobs > 0:
                 self.ongoing_jobs -= 1
+            self.metrics.record_end(run_time, outcome, busy)
+            # Waiters may be a task of the pool, that does not wait for itself (see ThreadPool.wait)
+            if self.work_waiters and outcome is not None and self._pending_jobs_no_lock() <= 1:
+                self.work_done.notify_all()
         finally:
             self.task_lock.release()
 
-    def get_next_task(self):
+    def worker_started(self, thread: 'ThreadPoolThread'):
+        """
+        Called by each worker thread when it starts, before asking for tasks
+        """
+        if self.worker_init is not None:
+            # noinspection PyBroadException
+            try:
+                self.worker_init()
+            except Exception:
+                logger.exception('caught error in worker init hook of thread {}: {}'.format(
+                    thread.name, self.worker_init))
+
+    def worker_stopped(self, thread: 'ThreadPoolThread'):
+        """
+        Called by each worker thread when it exits: runs the exit hook, then closes the resources of the thread
+        """
+        if self.work_stealing:
+            self.release_local_tasks(thread)
+        if self.worker_exit is not None:
+            # noinspection PyBroadException
+            try:
+                self.worker_exit()
+            except Exception:
+                logger.exception('caught error in worker exit hook of thread {}: {}'.format(
+                    thread.name, self.worker_exit))
+        for name, resource in thread.resources.items():
+            close = getattr(resource, 'close', None)
+            if callable(close):
+                # noinspection PyBroadException
+                try:
+                    close()
+                except Exception:
+                    logger.exception('caught error while closing resource "{}" of thread {}'.format(
+                        name, thread.name))
+        thread.resources.clear()
+
+    def get_next_task(self, _thread: 'ThreadPoolThread' = None) -> PoolTask or None:
 
         """ Retrieve the next task from the task queue.  For use
-        only by ThreadPoolThread objects contained in the pool."""
+        only by ThreadPoolThread objects contained in the pool.
 
+        When called by a pooled thread, blocks on the task lock until a
+        task is queued (and, for rate limited pools, allowed to start) or
+        the thread is killed; otherwise, returns immediately.  Threads of
+        an autoscaling pool stop waiting after the keep alive delay, and
+        get None.
+        :param _thread: the pooled thread asking for a task"""
+
+        stealing = self.work_stealing and _thread is not None
+        if stealing and not _thread.is_dying:
+            pool_task = self._pop_local(_thread)
+            if pool_task is not None:
+                _thread.is_busy = True
+                _thread.current_task = pool_task
+                _thread.busy_since = time.monotonic()
+                return pool_task
+        if self.is_autoscaling:
+            idle_until = time.monotonic() + self.keep_alive
+        local_task = None
         self.task_lock.acquire()
         try:
-            if not self.tasks:
-                return None, None, None, None, None, None, None, None
+            while True:
+                if _thread is not None and _thread.is_dying:
+                    return None
+                delay = None
+                if self.tasks:
+                    if self.rate_limiter is None:
+                        break
+                    delay = self.rate_limiter.try_acquire()
+                    if not delay:
+                        break
+                if stealing:
+                    local_task = self._pop_local(_thread, locked=True)
+                    if local_task is not None:
+                        break
+                if _thread is None:
+                    return None
+                self.idle_threads += 1
+                try:
+                    if self.is_autoscaling:
+                        remaining = idle_until - time.monotonic()
+                        if remaining <= 0:
+                            return None
+                        delay = remaining if delay is None else min(delay, remaining)
+                    self.task_lock.wait(delay)
+                finally:
+                    self.idle_threads -= 1
+            if local_task is not None:
+                pool_task = local_task
             else:
-                return self.tasks.pop(0)
+                if self.max_queue_size is not None:
+                    self.queue_not_full.notify()
+                pool_task = self.tasks.popleft()
+                if self.work_waiters and not self.tasks:
+                    self.work_done.notify_all()
+            if _thread is not None:
+                _thread.is_busy = True
+                _thread.current_task = pool_task
+                _thread.busy_since = time.monotonic()
+                if not pool_task.local:
+                    self.metrics.record_start(_thread.busy_since - pool_task.queued_at)
+            must_grow = self.scale_up_wait is not None \
+                and self.tasks \
+                and time.monotonic() - pool_task.queued_at >= self.scale_up_wait
         finally:
             self.task_lock.release()
+        if must_grow and self.is_autoscaling:
+            self.grow()
+        return pool_task
 
     def join_all(self, wait_for_pending_tasks=True, wait_for_running_tasks=True):
 
         """ Clear the task queue and terminate all pooled threads,
         optionally allowing the tasks and threads to finish.
+
+        Running tasks that are not waited for have their CancelToken
+        cancelled.  Scheduled tasks that were not queued yet are
+        cancelled.
         :param wait_for_pending_tasks: whether or not to process pending tasks before joining
-        :param wait_for_running_tasks: whether or not to wait for running tasks before joining"""
+        :param wait_for_running_tasks: whether or not to wait for running tasks before joining
+
+        The pool is also a context manager, that calls join_all() on
+        exit.  See ThreadPool.wait to wait for the tasks without
+        stopping the threads, and ThreadPool.drain to give up after a
+        timeout."""
 
         # Mark the pool as joining to prevent any more task queueing
         self.is_joining = True
+        self.cancel_schedules()
+        self.task_lock.acquire()
+        try:
+            self.queue_not_full.notify_all()
+        finally:
+            self.task_lock.release()
 
         # Wait for tasks to finish
         if wait_for_pending_tasks:
-            while self.tasks:
-                time.sleep(.1)
+            if wait_for_running_tasks:
+                self.wait()
+            else:
+                self._wait_until(lambda: not self._has_pending_tasks_no_lock())
+        else:
+            self.cancel_pending_tasks()
+
+        if not wait_for_running_tasks:
+            for thread in list(self.threads):
+                pool_task = thread.current_task
+                if pool_task is not None:
+                    pool_task.cancel_token.cancel()
 
         # Tell all the threads to quit
         self.resize_lock.acquire()
         try:
+            threads = list(self.threads)
             self.set_thread_count_no_lock(0)
             self.is_joining = True
+        finally:
+            self.resize_lock.release()
 
-            # Wait until all threads have exited
-            if wait_for_running_tasks:
-                for t in self.threads:
+        # Wait until all threads have exited; without holding the resize lock, running tasks may need it
+        if wait_for_running_tasks:
+            for t in threads:
+                if t is not threading.current_thread():
                     t.join()
-                    del t
 
-            # Reset the pool for potential reuse
-            self.is_joining = False
+        self.process_executor_lock.acquire()
+        try:
+            executor, self.process_executor = self.process_executor, None
         finally:
-            self.resize_lock.release()
+            self.process_executor_lock.release()
+        if executor is not None:
+            executor.shutdown(wait=wait_for_running_tasks)
+
+        # Reset the pool for potential reuse
+        self.is_joining = False
+
+    def metrics_snapshot(self) -> dict:
+        """
+        Returns the metrics of this pool: task counters, queue wait and run time histograms, and how busy the
+        threads are
+        """
+        snapshot = self.metrics.snapshot()
+        now = time.monotonic()
+        threads = list(self.threads)
+        thread_busy_ratio = {}
+        lifetime = 0.0
+        busy = 0.0
+        for thread in threads:
+            thread_lifetime = now - thread.started_at
+            thread_busy = thread.busy_seconds
+            if thread.busy_since is not None:
+                thread_busy += now - thread.busy_since
+            thread_busy_ratio[thread.name] = thread_busy / thread_lifetime if thread_lifetime > 0 else 0.0
+            lifetime += thread_lifetime
+            busy += thread_busy
+        snapshot.update({
+            'pool': self.basename,
+            'threads': len(threads),
+            'idle_threads': self.idle_threads,
+            'queue_depth': len(self.tasks),
+            'ongoing_jobs': self.pending_jobs(),
+            'busy_ratio': busy / lifetime if lifetime > 0 else 0.0,
+            'thread_busy_ratio': thread_busy_ratio,
+        })
+        return snapshot
 
     def all_done(self):
         """
         Checks for ongoing activities in this ThreadPool
         :return: True if all Workers are done, False otherwise
         """
-        return self.ongoing_jobs == 0
+        return self.pending_jobs() == 0
+
+
+class PoolRegistry:
+    """
+    Named ThreadPools shared by the components of a process, instead of each of them starting its own threads
+
+    The registry can cap the total number of threads of its pools: pools do not grow beyond that limit, except
+    that each of them always gets at least one thread.
+    """
+
+    def __init__(self, max_total_threads: int = None):
+        self.max_total_threads = None
+        self.set_max_total_threads(max_total_threads)
+        self.pools = {}
+        self._lock = threading.Lock()
+        # Held by pools while they start threads; always taken last
+        self.thread_lock = threading.Lock()
+
+    def get_pool(self, name: str, num_threads: int = 1, **options) -> ThreadPool:
+        """
+        Returns the pool registered under "name", creating it if needed
+
+        A pool is shared by everyone asking for it: it grows to the largest number of threads it was asked for
+        (within the limit of the registry). Shared pools should not be joined by the components using them; see
+        PoolRegistry.shutdown.
+        :param name: name of the pool, also used as the base name of its threads
+        :param num_threads: minimum number of threads the caller needs
+        :param options: options for ThreadPool, used only when creating the pool (_max_threads is raised to
+            num_threads if needed)
+        :return: ThreadPool
+        """
+        with self._lock:
+            pool = self.pools.get(name)
+            if pool is None:
+                options.setdefault('_daemon', True)
+                pool = ThreadPool(num_threads, name, _registry=self, **options)
+                self.pools[name] = pool
+                return pool
+        pool.resize_lock.acquire()
+        try:
+            pool.min_threads = max(pool.min_threads, num_threads)
+            if pool.is_autoscaling:
+                pool.max_threads = max(pool.max_threads, num_threads)
+            if not pool.is_joining and len(pool.threads) < pool.min_threads:
+                pool.set_thread_count_no_lock(pool.min_threads)
+        finally:
+            pool.resize_lock.release()
+        return pool
+
+    def total_threads(self) -> int:
+        """
+        :return: number of threads in every pool of the registry
+        """
+        return sum(len(pool.threads) for pool in list(self.pools.values()))
+
+    def room(self) -> int or float:
+        """
+        :return: number of threads that can still be started within the limit, if any
+        """
+        if self.max_total_threads is None:
+            return float('inf')
+        return max(self.max_total_threads - self.total_threads(), 0)
+
+    def set_max_total_threads(self, max_total_threads: int = None):
+        """
+        Changes the limit on the total number of threads; pools that are already above it are not shrunk, but
+        will not grow anymore
+        :param max_total_threads: new limit; None to remove it
+        """
+        if max_total_threads is not None and max_total_threads < 1:
+            raise ValueError('max total threads must be >= 1, got {}'.format(max_total_threads))
+        self.max_total_threads = max_total_threads
+
+    def shutdown(self, wait: bool = True):
+        """
+        Joins every pool of the registry and forgets about them
+        :param wait: whether or not to wait for pending and running tasks
+        """
+        with self._lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.join_all(wait, wait)
+
+
+_REGISTRY = PoolRegistry()
+
+
+def get_pool_registry() -> PoolRegistry:
+    """
+    Returns the PoolRegistry shared by the whole process
+    """
+    return _REGISTRY
+
+
+def get_shared_pool(name: str, num_threads: int = 1, **options) -> ThreadPool:
+    """
+    Returns the ThreadPool registered under "name" in the registry shared by the whole process, see
+    PoolRegistry.get_pool
+    """
+    return _REGISTRY.get_pool(name, num_threads, **options)
+
+
+class TaskGraph:
+    """
+    Runs tasks on a ThreadPool as soon as the tasks they depend on are done
+
+    Each task added to the graph gets a Future. A task depending on other Futures is queued once all of them
+    succeeded, and receives their results as its first positional arguments, in order. If any dependency fails
+    or is cancelled, the task is cancelled too, and so are its own dependents.
+
+        graph = TaskGraph(pool)
+        releases = graph.add(fetch_releases)
+        asset = graph.add(pick_asset, _depends_on=[releases])
+        path = graph.add(download, _depends_on=[asset])
+        graph.add(verify_hash, expected_hash, _depends_on=[path])
+        graph.wait()
+    """
+
+    def __init__(self, pool: ThreadPool):
+        self.pool = pool
+        self.nodes = []
+
+    def add(self, task: callable, *args, _depends_on=(), _priority: int = 0, _lane: str = None, **kwargs) -> Future:
+        """
+        Adds a task to the graph
+        :param task: callable task
+        :param args: args for the task, appended to the results of its dependencies
+        :param kwargs: kwargs for the task
+        :param _depends_on: Futures (from this graph or from ThreadPool.submit) this task depends on
+        :param _priority: tasks with a higher priority are dispatched first
+        :param _lane: name of the lane to queue the task in
+        :return: concurrent.futures.Future
+        """
+        if task is None or isinstance(task, bool) or not callable(task):
+            raise ValueError('task must be a callable, got {}'.format(type(task)))
+        dependencies = list(_depends_on)
+        node = Future()
+        self.nodes.append(node)
+
+        if not dependencies:
+            self._schedule(node, task, (), args, kwargs, _priority, _lane)
+            return node
+
+        remaining = [len(dependencies)]
+        remaining_lock = threading.Lock()
+
+        def on_dependency_done(dependency: Future):
+            if dependency.cancelled() or dependency.exception() is not None:
+                self._cancel_node(node)
+                return
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            results = tuple(dependency.result() for dependency in dependencies)
+            self._schedule(node, task, results, args, kwargs, _priority, _lane)
+
+        for dependency in dependencies:
+            dependency.add_done_callback(on_dependency_done)
+        return node
+
+    def _schedule(self, node: Future, task: callable, results: tuple, args: tuple, kwargs: dict,
+                  priority: int, lane: str):
+        if not self._set_running_or_notify_cancel(node):
+            return
+        try:
+            future = self.pool.submit(task, *(results + args), _priority=priority, _lane=lane, **kwargs)
+        except Exception as e:
+            node.set_exception(e)
+            return
+
+        def on_task_done(_):
+            if future.cancelled():
+                node.set_exception(CancelledError())
+            elif future.exception() is not None:
+                node.set_exception(future.exception())
+            else:
+                node.set_result(future.result())
+
+        future.add_done_callback(on_task_done)
+
+    @staticmethod
+    def _set_running_or_notify_cancel(node: Future) -> bool:
+        try:
+            return node.set_running_or_notify_cancel()
+        except RuntimeError:
+            # Cancellation was already notified
+            return False
+
+    def _cancel_node(self, node: Future):
+        # Future.cancel does not wake up threads blocked in concurrent.futures.wait; the state change has to be
+        # notified the same way executors do it
+        if node.cancel():
+            self._set_running_or_notify_cancel(node)
+
+    def cancel(self):
+        """
+        Cancels every task of the graph that has not been queued yet
+        """
+        for node in self.nodes:
+            self._cancel_node(node)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits for every task of the graph to be done, failed or cancelled
+        :param timeout: maximum number of seconds to wait; None (default) to wait forever
+        :return: True if the whole graph is done, False if the timeout expired
+        """
+        return not wait(self.nodes, timeout).not_done
+
+
+class AsyncThreadPool(Executor):
+    """
+    Adapter exposing a ThreadPool as a concurrent.futures Executor, so it can be used with
+    asyncio's loop.run_in_executor, and awaited from coroutines with AsyncThreadPool.run
+    """
+
+    def __init__(self, pool: ThreadPool):
+        self.pool = pool
+
+    def submit(self, fn: callable, *args, **kwargs) -> Future:
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        self.pool.join_all(wait, wait)
+
+    async def run(self, task: callable, *args, **kwargs):
+        """
+        Runs a task in the pool without blocking the event loop, and returns its result
+        """
+        return await self.pool.submit_async(task, *args, **kwargs)
 
 
 class ThreadPoolThread(threading.Thread):
     """ Pooled thread class. """
 
-    threadSleepTime = 0.1
-
     def __init__(self, _pool, _thread_name, _daemon):
 
         """ Initialize the thread and remember the pool. """
@@ -206,36 +2184,83 @@ class ThreadPoolThread(threading.Thread):
         threading.Thread.__init__(self, name=_thread_name, daemon=_daemon)
         self.__pool = _pool
         self.__isDying = False
+        self.is_busy = False
+        self.current_task = None
+        self.cancel_token = None
+        self.started_at = time.monotonic()
+        self.busy_since = None
+        self.busy_seconds = 0.0
         self.exc_info = None
+        self.local_tasks = collections.deque()
+        self.spawned = 0
+        self.resources = {}
 
-    @staticmethod
-    def __run_with_optional_args(runnable: callable, args: list, kwargs: dict):
-        if args and kwargs:
-            return runnable(*args, **kwargs)
-        elif args:
-            return runnable(*args)
-        elif kwargs:
-            return runnable(**kwargs)
-        else:
-            return runnable()
+    @property
+    def is_dying(self) -> bool:
+        return self.__isDying
 
-    def __run(self, cmd, args, kwargs, callback, err_call_back, err_args, err_kwargs, task_id):
+    @property
+    def pool(self) -> ThreadPool:
+        return self.__pool
+
+    def __run(self, pool_task: PoolTask):
+        self.cancel_token = pool_task.cancel_token
+        start = self.busy_since
+        time_limit = None
+        if pool_task.time_limit is not None:
+            time_limit = get_timer().call_later(pool_task.time_limit, self.__pool.on_time_limit, self, pool_task)
+        outcome = None
+        try:
+            if pool_task.future is not None:
+                outcome = self.__run_future(pool_task)
+            else:
+                outcome = self.__run_callback(pool_task)
+        finally:
+            if time_limit is not None:
+                time_limit.cancel()
+            run_time = time.monotonic() - start
+            self.busy_seconds += run_time
+            self.busy_since = None
+            queue_wait = start - pool_task.queued_at if pool_task.local else None
+            self.__pool.task_done(run_time, outcome, pool_task, queue_wait)
+            self.cancel_token = None
+            self.current_task = None
+
+    def __run_callback(self, pool_task: PoolTask) -> str or None:
+        cmd, args, kwargs = pool_task.task, pool_task.args, pool_task.kwargs
+        callback, task_id = pool_task.callback, pool_task.task_id
+        err_call_back, err_args, err_kwargs = pool_task.err_callback, pool_task.err_args, pool_task.err_kwargs
+        claimed = False
         # noinspection PyBroadException
         try:
-            return_value = self.__run_with_optional_args(cmd, args, kwargs)
-            if callback is not None:
+            return_value = self.__pool.execute(cmd, args, kwargs)
+            claimed = self.__pool.claim(pool_task)
+            if claimed:
+                self.__pool.settle_followers(pool_task, 'completed', return_value)
+            if claimed and callback is not None:
                 if task_id is not None:
                     callback((task_id, return_value))
                 else:
                     callback(return_value)
+            return 'completed' if claimed else None
         except SystemExit:
+            claimed = claimed or self.__pool.claim(pool_task)
             import _thread
             _thread.interrupt_main()
+            return 'failed' if claimed else None
         except KeyboardInterrupt:
+            claimed = claimed or self.__pool.claim(pool_task)
             import _thread
             _thread.interrupt_main()
+            return 'failed' if claimed else None
         except:
             import sys
+            error = sys.exc_info()[1]
+            if not claimed and self.__pool.retry(self, pool_task, error):
+                return None
+            claimed = claimed or self.__pool.claim(pool_task)
+            if not claimed:
+                return None
             logger.error(
                 'caught error in worker thread:'
                 '\ncmd: {} args: {} kwargs: {}'
@@ -246,32 +2271,76 @@ class ThreadPoolThread(threading.Thread):
                     sys.exc_info()[0], sys.exc_info()[1]
                 )
             )
-            if err_call_back:
-                self.__run_with_optional_args(err_call_back, err_args, err_kwargs)
-            else:
-                if SENTRY:
-                    SENTRY.captureException(sys.exc_info())
-        finally:
-            self.__pool.task_done()
+            # noinspection PyBroadException
+            try:
+                if err_call_back:
+                    _run_with_optional_args(err_call_back, err_args, err_kwargs)
+                else:
+                    if SENTRY:
+                        SENTRY.captureException(sys.exc_info())
+            except Exception:
+                logger.exception('caught error in error callback: {}'.format(err_call_back))
+            self.__pool.settle_followers(pool_task, 'failed', error=error)
+            return 'failed'
+
+    def __run_future(self, pool_task: PoolTask) -> str or None:
+        future = pool_task.future
+        if not future.running() and not future.set_running_or_notify_cancel():
+            if not self.__pool.claim(pool_task):
+                return None
+            self.__pool.settle_followers(pool_task, 'cancelled')
+            return 'cancelled'
+        try:
+            result = self.__pool.execute(pool_task.task, pool_task.args, pool_task.kwargs)
+        except (SystemExit, KeyboardInterrupt) as e:
+            claimed = self.__pool.claim(pool_task)
+            if claimed:
+                future.set_exception(e)
+                self.__pool.settle_followers(pool_task, 'failed', error=e)
+            import _thread
+            _thread.interrupt_main()
+        except BaseException as e:
+            if self.__pool.retry(self, pool_task, e):
+                return None
+            claimed = self.__pool.claim(pool_task)
+            if claimed:
+                future.set_exception(e)
+                self.__pool.settle_followers(pool_task, 'failed', error=e)
+        else:
+            claimed = self.__pool.claim(pool_task)
+            if claimed:
+                future.set_result(result)
+                self.__pool.settle_followers(pool_task, 'completed', result)
+                return 'completed'
+        return 'failed' if claimed else None
 
     def run(self):
 
-        """ Until told to quit, retrieve the next task and execute
+        """ Until told to quit, wait for the next task and execute
         it, calling the callback if any.  """
 
-        while not self.__isDying:
-            cmd, args, kwargs, callback, err_call_back, err_args, err_kwargs, task_id = self.__pool.get_next_task()
-            if cmd is None:
-                time.sleep(ThreadPoolThread.threadSleepTime)
-            else:
-                if SENTRY:
-                    with SENTRY.context:
-                        self.__run(cmd, args, kwargs, callback, err_call_back, err_args, err_kwargs, task_id)
-                else:
-                    self.__run(cmd, args, kwargs, callback, err_call_back, err_args, err_kwargs, task_id)
+        self.__pool.worker_started(self)
+        try:
+            while not self.__isDying:
+                pool_task = self.__pool.get_next_task(self)
+                if pool_task is None:
+                    if not self.__isDying:
+                        self.__pool.retire_idle_thread(self)
+                    continue
+                try:
+                    if SENTRY:
+                        with SENTRY.context:
+                            self.__run(pool_task)
+                    else:
+                        self.__run(pool_task)
+                finally:
+                    self.is_busy = False
+        finally:
+            self.__pool.worker_stopped(self)
 
     def kill(self):
 
         """ Exit the run loop next time through."""
 
         self.__isDying = True
+        self.__pool.wake_all_threads()
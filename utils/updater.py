@@ -4,6 +4,7 @@ import abc
 import io
 import re
 import subprocess
+import threading
 from collections import UserDict
 
 import humanize
@@ -12,11 +13,11 @@ import semver
 from utils.av import AVSession, AVBuild
 from utils.custom_logging import make_logger
 from utils.custom_path import Path
-from utils.downloader import Downloader
+from utils.downloader import DownloadCache, Downloader
 from utils.gh import GHRelease, GHSession
 from utils.monkey import nice_exit
 from utils.progress import Progress
-from utils.threadpool import ThreadPool
+from utils.threadpool import get_shared_pool, worker_resource
 
 logger = make_logger(__name__)
 
@@ -296,8 +297,13 @@ class AvailableReleases(UserDict):
 class BaseUpdater(abc.ABC):
     def __init__(self):
         self._available = AvailableReleases()
+        # tasks of the same updater may run at once on the shared pool: held while self._available is gathered and
+        # filtered
+        self._available_lock = threading.Lock()
 
-        self.pool = ThreadPool(_num_threads=1, _basename='updater', _daemon=True)
+        # the pool is shared by every updater, and the update hooks may wait for the user: let it grow, so that one
+        # updater waiting on a hook does not stall the others
+        self.pool = get_shared_pool('updater', 1, _max_threads=8)
 
     @abc.abstractmethod
     def release_has_assets(self, release: AbstractRelease) -> bool:
@@ -373,8 +379,9 @@ class BaseUpdater(abc.ABC):
             logger.error('no release found')
 
     def _get_latest_release(self, channel: str = 'stable', branch: str = None):
-        self._gather_available_releases()
-        return self._available.filter_by_channel(channel).filter_by_branch(branch).get_latest_release()
+        with self._available_lock:
+            self._gather_available_releases()
+            return self._available.filter_by_channel(channel).filter_by_branch(branch).get_latest_release()
 
     def get_latest_release(
             self,
@@ -383,14 +390,22 @@ class BaseUpdater(abc.ABC):
             success_callback: callable = None,
             failure_callback: callable = None,
     ):
+        # identical requests made while one is still pending share its result instead of gathering releases again;
+        # the pool is shared by every updater, so the ID includes this one (it cannot be reused while the task holds
+        # a reference to it)
+        def _task_callback(result):
+            success_callback(result[1])
+
         self.pool.queue_task(
             task=self._get_latest_release,
             kwargs=dict(
                 channel=channel,
                 branch=branch,
             ),
-            _task_callback=success_callback,
-            _err_callback=failure_callback
+            _task_callback=_task_callback if success_callback else None,
+            _err_callback=failure_callback,
+            _task_id=('latest_release', id(self), channel, branch),
+            _coalesce=True,
         )
 
     def _download_asset(
@@ -402,7 +417,9 @@ class BaseUpdater(abc.ABC):
             download_retries: int = 3,
             block_size: int = 4096,
             progress_hooks: callable = None,
-            hash_method: str = 'md5'
+            hash_method: str = 'md5',
+            concurrent_download: int = 1,
+            cache: DownloadCache = None
     ) -> bool:
         """"""
 
@@ -431,10 +448,15 @@ class BaseUpdater(abc.ABC):
                 filename='./update',
                 content_length=asset.size,
                 hexdigest=hexdigest,
+                concurrent_download=concurrent_download,
                 download_retries=download_retries,
                 block_size=block_size,
                 progress_hooks=[progress_hooks],
-                hash_method=hash_method
+                hash_method=hash_method,
+                stream=True,
+                check_length=True,
+                resume=True,
+                cache=cache,
             ).download()
         else:
             logger.error('release has no asset')
@@ -518,15 +540,15 @@ class BaseUpdater(abc.ABC):
                 logger.debug('calling no candidate hook')
                 no_candidates_hook()
 
-        self._gather_available_releases()
-
         current_version = Version(current_version)
 
         if branch is None:
             branch = current_version.branch
 
-        candidates = self._available.filter_by_channel(channel)
-        candidates = candidates.filter_by_branch(branch)
+        with self._available_lock:
+            self._gather_available_releases()
+            candidates = self._available.filter_by_channel(channel)
+            candidates = candidates.filter_by_branch(branch)
 
         if not candidates:
             logger.info('no new version found')
@@ -624,11 +646,12 @@ class GHUpdater(BaseUpdater):
 class AVUpdater(BaseUpdater):
     def _get_artifacts(self, release):
         if release.version.version_str not in self.__artifacts:
-            build = AVSession().get_build_by_version(
+            session = worker_resource('av_session', AVSession)
+            build = session.get_build_by_version(
                 self._av_user, self._av_project, release.build.version.url_safe_version_str
             )
             job_id = build.build.jobs[0].jobId
-            self.__artifacts[release.version.version_str] = (AVSession().get_artifacts(job_id), job_id)
+            self.__artifacts[release.version.version_str] = (session.get_artifacts(job_id), job_id)
         return self.__artifacts[release.version.version_str]
 
     def release_has_assets(self, release: AVRelease) -> bool:
@@ -647,7 +670,8 @@ class AVUpdater(BaseUpdater):
         return AVRelease
 
     def _contact_remote_host_for_available_releases(self) -> list:
-        return list(AVSession().get_history(self._av_user, self._av_project).builds.successful_only())
+        session = worker_resource('av_session', AVSession)
+        return list(session.get_history(self._av_user, self._av_project).builds.successful_only())
 
     def __init__(
             self,